@@ -6,58 +6,390 @@
 # Update: 2025-01 for Winter 2025 (Xuheng Cai)
 ######################################################################
 import util
-from pydantic import BaseModel, Field
+from conversation import ChatSession, session_attribute
 
+import copy
+from functools import lru_cache, partial
 import numpy as np
+import os
 import random
 import re 
 import csv
-from porter_stemmer import PorterStemmer
+from porter_stemmer import CachingStemmer
+from ranking import RankedCursor
+import neighbors
+import delta_log
+import threading
+import fast_porter_stemmer
+from concurrent.futures import ProcessPoolExecutor
 
+# Quoted movie titles in a line of user input
+TITLE_PATTERN = re.compile(r'"([^"]+)"')
+
+# extract_sentiment_batch() only starts worker processes for at least this
+# many lines; below it, process start-up costs more than it saves
+BATCH_PROCESS_THRESHOLD = 20000
+
+
+class RatingsModel:
+    """The ratings data a Chatbot shares with its per-session copies (see
+    Chatbot.for_session()). Updates rewrite the changed rows under the lock,
+    so every session sees them, then bump the version."""
+
+    def __init__(self):
+        # Incremented every time the ratings change (see
+        # Chatbot.apply_rating_events()), so sessions can tell their running
+        # scores are out of date
+        self.version = 0
+        # Held while the ratings are updated
+        self.lock = threading.RLock()
+
+
+def model_attribute(name):
+    """A property that reads and writes `name` on the object's RatingsModel."""
+    return property(lambda self: getattr(self.model, name),
+                    lambda self, value: setattr(self.model, name, value),
+                    doc=f'RatingsModel.{name} shared by every session')
+
+
+def score_sentiment(preprocessed_input, titles, stem, lexicon, negation_stems):
+    """Sentiment (-1, 0 or 1) of one line, ignoring the words of its titles.
+
+    The scoring loop behind Chatbot.extract_sentiment() and
+    extract_sentiment_batch().
+
+    :param preprocessed_input: a line pre-processed with preprocess()
+    :param titles: movie titles extracted from the line
+    :param stem: function returning the stem of a word
+    :param lexicon: dictionary from stem to polarity (+1 pos, -1 neg)
+    :param negation_stems: stems of the words that flip the next sentiment word
+    :returns: -1 if negative, 0 if neutral, 1 if positive
+    """
+    # Convert input into list of lowercase words
+    preprocessed_input = preprocessed_input.lower()
+
+    # Remove movie titles before sentiment analysis
+    for title in titles:
+        preprocessed_input = preprocessed_input.replace(title.lower(), "")
+
+    # Initialize sentiment score
+    sentiment = 0
+
+    # Negation Flag
+    Negation = False
+
+    for word in preprocessed_input.split():
+        stemmed_word = stem(word)
+
+        # If negation word, do not use it for score and set negation flag
+        if stemmed_word in negation_stems:
+            Negation = True
+            continue
+
+        polarity = lexicon.get(stemmed_word)
+        if polarity is not None:
+            # Add the word's polarity (+1 pos, -1 neg), flipped if neg flag set
+            sentiment += -polarity if Negation else polarity
+            Negation = False  # Reset negation after processing a sentiment word
+
+    # Determine output (1 if score is pos, -1 if score is neg, 0 otherwise)
+    return (sentiment > 0) - (sentiment < 0)
+
+
+# Lexicon, negation stems and stemmer of an extract_sentiment_batch() worker
+_worker_sentiment = None
+
+
+def _init_sentiment_worker(lexicon, negation_stems):
+    global _worker_sentiment
+    stemmer = CachingStemmer(stem_function=fast_porter_stemmer.stem)
+    _worker_sentiment = (stemmer.stem, lexicon, negation_stems)
+
+
+def _score_sentiment_chunk(lines):
+    stem, lexicon, negation_stems = _worker_sentiment
+    return [score_sentiment(line, TITLE_PATTERN.findall(line.lower()), stem,
+                            lexicon, negation_stems)
+            for line in lines]
+
+
+@lru_cache(maxsize=None)
+def emotion_extractor_schema():
+    """The pydantic model extract_emotion() asks the LLM to fill in.
+
+    Built on first use, so runs without the LLM never import pydantic.
+    """
+    from pydantic import BaseModel, Field
+
+    class EmotionExtractor(BaseModel):
+        emotions: list = Field(default_factory=list)
+
+    return EmotionExtractor
 
 
 # noinspection PyMethodMayBeStatic
 class Chatbot:
     """Simple class to implement the chatbot for PA 7."""
 
-    def __init__(self, llm_enabled=False):
+    # Words that flip the sentiment of the next sentiment word
+    NEGATION_WORDS = ("not", "never", "no", "n't", "didn't", "doesn't", "isn't", "wasn't", 
+                      "shouldn't", "couldn't", "won't", "hadn't", "wouldn't", "don't", "can't")
+
+    # Number of similarity_column() results kept in memory (one float vector
+    # of length num_movies each)
+    SIMILARITY_CACHE_SIZE = 256
+    # Number of recommendations fetched at a time while recommending
+    REC_PAGE_SIZE = 10
+    # recommend() treats scores equal to this many decimals as ties, broken
+    # by movie index, so the ranking doesn't depend on the order in which
+    # the floating-point scores were summed
+    SCORE_DECIMALS = 12
+
+    # Every status _select_response_variant() knows how to respond to
+    RESPONSE_STATUSES = (
+        "Invalid Input: No Movie Title",
+        "Invalid Input: Multiple Movie Titles",
+        "Invalid Input: Movie Not in Database Title",
+        "Invalid Input: Multiple movies in database",
+        "Keep rating",
+        "neutral_movie_response",
+        "pos_movie_response",
+        "neg_movie_response",
+        "recommending mode",
+        "out of recommendations",
+        "No More Recs Wanted",
+        "Recommending Mode Invalid Input",
+    )
+
+    def __init__(self, llm_enabled=False, sparse_ratings=False, neighbor_count=0,
+                 parse_workers=None, delta_log_path=None):
         # The chatbot's default name is `moviebot`.
         # TODO: Give your chatbot a new name.
         self.name = 'movie_recommender'
 
         self.llm_enabled = llm_enabled
+        # Keep the ratings matrix in scipy CSR form instead of a dense array
+        self.sparse_ratings = sparse_ratings
+        # Recommend only movies among the rated movies' neighbor_count most
+        # similar movies (0 = consider every movie)
+        self.neighbor_count = neighbor_count
+        # Processes parsing ratings.txt and movies.txt when no snapshot exists
+        # (None = util.PARSE_WORKERS)
+        self.parse_workers = parse_workers
+        # Ratings data shared with every session
+        self.model = RatingsModel()
+        # Log of ratings added since ratings.txt was written (see
+        # delta_log.py), if enabled
+        self.delta_log = None
+        if delta_log_path:
+            self.delta_log = delta_log.DeltaLog(delta_log_path)
+            self.delta_log.start()
+
+        # One memoizing stemmer shared by the lexicon loader and
+        # extract_sentiment(), plus the stems of the negation words
+        self.stemmer = CachingStemmer(stem_function=fast_porter_stemmer.stem)
+        self.negation_stems = {self.stemmer.stem(word) for word in self.NEGATION_WORDS}
 
         # This matrix has the following shape: num_movies x num_users
         # The values stored in each row i and column j is the rating for
         # movie i by user j
-        self.titles, ratings = util.load_ratings('data/ratings.txt')
-        self.sentiment = self.load_sentiment_dictionary('data/sentiment.txt')
+        # Pre-stemmed sentiment.txt: stem -> polarity (1 for 'pos', -1 for
+        # 'neg'), compiled once and cached under data/cache
+        self.sentiment = util.load_sentiment_lexicon('data/sentiment.txt',
+                                                     self.stemmer.stem)
+        # Normalized title -> movie indices, so title lookups never rescan
+        # data/movies.txt
+        self.title_index = self._build_title_index('data/movies.txt')
 
         ########################################################################
         # TODO: Binarize the movie ratings matrix.                             #
         ########################################################################
 
-        # Binarize the movie ratings before storing the binarized matrix.
-        self.ratings = self.binarize(ratings)
+        self._load_ratings_model()
+        # Apply the ratings logged since the snapshot was written
+        self.refresh_ratings()
         
-        # --Track Conversation State--
-        # Store user ratings 
-        self.user_ratings = np.zeros(len(self.titles))
-        # Count movies rated by the user
-        self.num_rated = 0
         # Hard code number of user ratings needed to before recommendation
         self.min_ratings_before_rec = 5
-        # Store current conversation state
-        self.recommending = False
-        
-        # --Recommending Storage
-        self.recommendations = []
-        self.curr_rec_count = 0 
+
+        # Pre-generate the llm preambles for every response status, starting
+        # with the first response
+        if self.llm_enabled:
+            self.preamble_pool = util.LLMResponsePool(
+                self._generate_preamble, self.RESPONSE_STATUSES)
+
+        # --Track Conversation State--
+        # Everything specific to one user's conversation (their ratings and
+        # recommendations) lives in a session object; see for_session()
+        self.session = ChatSession(len(self.titles))
         
         ########################################################################
         #                             END OF YOUR CODE                         #
         ########################################################################
 
+    def _load_ratings_model(self):
+        """Load the ratings and everything derived from them into the shared
+        RatingsModel."""
+        # Binarize the movie ratings before storing the binarized matrix. The
+        # binarized matrix is snapshotted under data/cache and memory-mapped on
+        # later runs, so only the first start pays for parsing ratings.txt.
+        # The mapping is copy-on-write: apply_rating_events() rewrites rows in
+        # memory, copying only the pages it touches, never the file.
+        self.titles, self.ratings = util.load_binarized_ratings(
+            'data/ratings.txt', self.binarize, sparse=self.sparse_ratings,
+            workers=self.parse_workers, mmap_mode='c')
+
+        # Unit-normalize every movie's rating vector once so that the cosine
+        # similarities needed by recommend() reduce to dot products. The
+        # snapshot keeps every row's norm, so they are not recomputed.
+        self.row_norms = util.load_row_norms('data/ratings.txt',
+                                             sparse=self.sparse_ratings)
+        if self.row_norms is None or len(self.row_norms) != self.ratings.shape[0]:
+            self.row_norms = util.row_norms(self.ratings)
+        self.normalized_ratings = self.normalize_rows(self.ratings, self.row_norms)
+        self.similarity_column = self._similarity_cache(self.normalized_ratings)
+        # Precomputed top-N neighbor lists (see neighbors.py), if enabled
+        self.neighbors = None
+        if self.neighbor_count:
+            self.neighbors = neighbors.load_neighbor_lists(
+                self.normalized_ratings, self.neighbor_count,
+                {'ratings': 'data/ratings.txt', 'titles': 'data/movies.txt'})
+        self.model.version += 1
+
+    def apply_rating_events(self, users, movies, ratings):
+        """Apply new raw ratings (user id, movie index, rating from 0.5 to
+        5.0; 0 removes a rating) to the shared ratings data in place.
+
+        Only what depends on the rated movies is recomputed: their entries
+        in the binarized matrix, their norms and rows of the normalized
+        matrix and their neighbor lists. The matrices are updated in place;
+        they are only copied when a new user needs a column, or when a
+        sparse matrix must store a new entry. A session scoring meanwhile
+        may see some rows updated and others not, but the version is bumped
+        afterwards, so it recomputes its running scores on its next rating
+        or recommendation. Applying the same events again changes nothing.
+
+        :returns: the number of events applied
+        """
+        users, movies, ratings = delta_log.valid_events(users, movies, ratings,
+                                                        len(self.titles))
+        if len(users) == 0:
+            return 0
+        with self.model.lock:
+            values = np.asarray(self.binarize(ratings))
+            ratings_matrix = delta_log.apply_events(self.ratings, users, movies, values)
+            changed = np.unique(movies)
+            norms = self.row_norms
+            if not norms.flags.writeable:
+                norms = np.array(norms, dtype=float)
+            norms[changed] = util.row_norms(ratings_matrix[changed])
+            normalized = self.normalized_ratings
+            if util.issparse(ratings_matrix):
+                if ratings_matrix is self.ratings:
+                    # Same stored entries, whose index arrays normalized
+                    # shares: only the changed rows' values are rescaled
+                    indptr = ratings_matrix.indptr
+                    positions = np.concatenate([np.arange(indptr[movie], indptr[movie + 1])
+                                                for movie in changed])
+                    normalized.data[positions] = self.normalize_rows(
+                        ratings_matrix[changed], norms[changed]).data
+                else:
+                    # The CSR arrays were rebuilt by the insertion anyway; only
+                    # the stored entries are rescaled, by the kept norms
+                    normalized = self.normalize_rows(ratings_matrix, norms)
+            else:
+                if normalized.shape != ratings_matrix.shape:
+                    # New users: other movies have no ratings from them
+                    widened = np.zeros(ratings_matrix.shape)
+                    widened[:, :normalized.shape[1]] = normalized
+                    normalized = widened
+                normalized[changed] = self.normalize_rows(ratings_matrix[changed],
+                                                          norms[changed])
+            if self.neighbors is not None:
+                self.neighbors = self.neighbors.updated(normalized, changed)
+
+            self.ratings, self.row_norms = ratings_matrix, norms
+            self.normalized_ratings = normalized
+            # Every cached column holds a similarity to a changed movie
+            self.similarity_column = self._similarity_cache(normalized)
+            self.model.version += 1
+        return len(users)
+
+    def refresh_ratings(self):
+        """Apply the ratings appended to the delta log since the last call.
+
+        :returns: the number of events applied
+        """
+        if self.delta_log is None:
+            return 0
+        with self.model.lock:
+            events = self.delta_log.read_new()
+            if events is None:
+                # Compacted away before this process read them, so the
+                # snapshot has them
+                self._load_ratings_model()
+                events = self.delta_log.read_new()
+            return self.apply_rating_events(*events)
+
+    def compact_ratings(self):
+        """Fold the delta log into data/ratings.txt and the ratings snapshot
+        (see delta_log.compact()). Neighbor lists on disk are
+        rebuilt from the new snapshot on the next start.
+
+        :returns: the number of bytes of events compacted
+        """
+        if self.delta_log is None:
+            return 0
+
+        def refresh():
+            self.refresh_ratings()
+            return self.ratings, self.row_norms
+
+        with self.model.lock:
+            return delta_log.compact(self.delta_log, refresh, self.titles,
+                                     'data/ratings.txt', 'data/movies.txt')
+
+    # Ratings data, stored on the RatingsModel shared by every session
+    ratings = model_attribute('ratings')
+    row_norms = model_attribute('row_norms')
+    normalized_ratings = model_attribute('normalized_ratings')
+    similarity_column = model_attribute('similarity_column')
+    neighbors = model_attribute('neighbors')
+    ratings_version = model_attribute('version')
+
+    # Conversation state, stored on the current session:
+    # Store user ratings 
+    user_ratings = session_attribute('user_ratings')
+    # Count movies rated by the user
+    num_rated = session_attribute('num_rated')
+    # Store current conversation state
+    recommending = session_attribute('recommending')
+    # --Recommending Storage
+    recommendations = session_attribute('recommendations')
+    rec_index = session_attribute('rec_index')
+    curr_rec_count = session_attribute('curr_rec_count')
+    rec_cursor = session_attribute('rec_cursor')
+    # Running sum_j cos(i, j) * user_ratings[j] for every movie i
+    scores = session_attribute('scores')
+    # ratings_version the running scores were computed for
+    scores_version = session_attribute('scores_version')
+
+    def for_session(self, session):
+        """Return a chatbot that shares this chatbot's loaded data (ratings,
+        titles, sentiment lexicon, ...) but keeps its conversation state in
+        the given session, so one process can hold many conversations.
+
+        :param session: a conversation.ChatSession
+        :returns: a Chatbot bound to that session
+        """
+        chatbot = copy.copy(self)
+        chatbot.session = session
+        return chatbot
+
+    def new_session(self):
+        """Return a fresh ChatSession sized for this chatbot's movies."""
+        return ChatSession(len(self.titles))
+
     ############################################################################
     #                                                                          #
     ############################################################################
@@ -129,32 +461,33 @@ class Chatbot:
         response = ""
         line = self.preprocess(line)
 
+        # Find movie titles if they are in the user input
+        movie_titles_extracted = self.extract_titles(format(line))
+        title_lookup = None
+
         ## implementing llm_programming functions 
         if self.llm_enabled:
-
-            ################### code for 6i  ##########################
-            emotions = self.extract_emotion(line)
-
-            if emotions: 
-                response+= self._llm_emotion_response(emotions)
-
             ################### code for 6h ############################
-            system_prompt = """You are a bot who identifies when an input is related to movies. You either return a 0 or a 1.
-            Follow these guidelines to decide what to return
-            - Return 0 if the input is directly related to movies. More specifically, if it can be said in a conversation between a user and a movie recommender bot.
-            - Return 0 if the input is a simple 'yes'/'no' or any of its variations (e.g. 'yeah', 'no')
-            - Return 1 if the input is not related to movies.
-            Do not include any additional information in your answer. JUST return 0 or 1."""
+            # Arbitrary input gets its own response, so nothing else is
+            # worth asking the LLM about until this check says otherwise
+            if self._is_arbitrary_input(line):
+                return self._llm_arbitrary_input(line)
 
-            llm_response = util.simple_llm_call(system_prompt, line, stop=["\n"])
-            is_arbitrary_input = bool(int(llm_response))
+            # A title lookup may need language detection and translation
+            # calls; it does not depend on the emotion acknowledgement, so it
+            # runs in the background meanwhile
+            if len(movie_titles_extracted) == 1:
+                title_lookup = util.submit_llm_call(
+                    self.find_movies_by_title, movie_titles_extracted[0])
 
-            if is_arbitrary_input: 
-                return self._llm_arbitrary_input(line)
+            ################### code for 6i  ##########################
+            # An unmatched quote discards the acknowledgement, so it is not
+            # requested then
+            unmatched_quote = (len(movie_titles_extracted) == 0
+                               and line.count('"') % 2 != 0)
+            if not unmatched_quote:
+                response += self._acknowledge_emotions(line)
 
-        # Find movie titles if they are in the user input
-        movie_titles_extracted = self.extract_titles(format(line))
-        
         # 1. Handle inputs with no movie titles 
         # (Case #1: If chatbot not in recommend mode, User Input is incorrect)
         # (Case #2: If chatbot in recommend mode, check input and give rec)
@@ -172,7 +505,11 @@ class Chatbot:
         
         # 3. Exactly one movie in the user input ==> Now Validate in Database
         curr_movie_title = movie_titles_extracted[0] # select current movie
-        found_movies_idx = self.find_movies_by_title(curr_movie_title) # Check database for current movie
+        # Check database for current movie (already started in llm programming mode)
+        if title_lookup is not None:
+            found_movies_idx = title_lookup.result()
+        else:
+            found_movies_idx = self.find_movies_by_title(curr_movie_title)
         
         if len(found_movies_idx) == 0: # Edge Case: No Movies found in database
             # Check "_select_response_variant" section 3. for output variations 
@@ -207,7 +544,9 @@ class Chatbot:
                 self.rec_index = 0
                 
                 # Use helper function to produce recommendations based on currently rated movies
-                self.recommendations = self.recommend(self.user_ratings, self.ratings)
+                self.rec_cursor = self.recommendation_cursor(
+                    self.user_ratings, self.ratings, scores=self._session_scores())
+                self.recommendations = self.rec_cursor.next_page(self.REC_PAGE_SIZE)
                 response += self._show_next_recommendation()
 
 
@@ -219,6 +558,30 @@ class Chatbot:
     ############################################################################
     # Helper functions for the process function                                #
     ############################################################################     
+    def _acknowledge_emotions(self, line):
+        """ Extract the emotions in the user input and, if there are any,
+        return an llm response acknowledging them (otherwise an empty string)
+        """
+        emotions = self.extract_emotion(line)
+
+        if emotions: 
+            return self._llm_emotion_response(emotions)
+        return ""
+
+    def _is_arbitrary_input(self, line):
+        """ Use an llm classifier to decide whether the user input is
+        unrelated to movies
+        """
+        system_prompt = """You are a bot who identifies when an input is related to movies. You either return a 0 or a 1.
+            Follow these guidelines to decide what to return
+            - Return 0 if the input is directly related to movies. More specifically, if it can be said in a conversation between a user and a movie recommender bot.
+            - Return 0 if the input is a simple 'yes'/'no' or any of its variations (e.g. 'yeah', 'no')
+            - Return 1 if the input is not related to movies.
+            Do not include any additional information in your answer. JUST return 0 or 1."""
+
+        llm_response = util.simple_llm_call(system_prompt, line, stop=["\n"], use_cache=True)
+        return bool(int(llm_response))
+
     def _llm_emotion_response(self, emotions): 
         """ Given set of emotions this helper function makes an llm call to 
         ackowledge the emotions
@@ -320,7 +683,7 @@ class Chatbot:
                 # Check "_select_response_variant" section 7. for output variations 
                 response = self._select_response_variant("pos_movie_response", curr_movie_title, None, None)
                 # record user ranking for current movie
-                self.user_ratings[curr_movie_idx] = 1
+                self._rate_movie(curr_movie_idx, 1)
                 # Update number of movies rated
                 self.num_rated = np.count_nonzero(self.user_ratings != 0)  
             #
@@ -329,12 +692,44 @@ class Chatbot:
                 # Check "_select_response_variant" section 8. for output variations 
                 response = self._select_response_variant("neg_movie_response", curr_movie_title, None, None)
                 # record user ranking for current movie
-                self.user_ratings[curr_movie_idx] = -1
+                self._rate_movie(curr_movie_idx, -1)
                 # Update number of movies rated
                 self.num_rated = np.count_nonzero(self.user_ratings != 0)  
                 # Update response
         return response
 
+    def _rate_movie(self, movie_idx, rating):
+        """Record the user's rating of a movie and fold the change into the
+        session's running scores: a new or changed rating r_j only adds
+        (r_j - old r_j) * cos(i, j) to every movie i's score, so recommend()
+        never has to recompute the scores from scratch.
+        """
+        self._session_scores()
+        delta = rating - self.user_ratings[movie_idx]
+        if delta and self.neighbors is not None:
+            # The rating may bring in new candidates, which need the scores
+            # of every rated movie, so the candidates are rescored
+            self.user_ratings[movie_idx] = rating
+            self.scores = self._user_scores(self.user_ratings, self.ratings)
+            return
+        if delta:
+            self.scores += delta * self.similarity_column(movie_idx)
+        self.user_ratings[movie_idx] = rating
+
+    def _session_scores(self):
+        """The session's running scores, recomputed from its ratings if the
+        shared ratings changed since they were last updated."""
+        # Read before scoring: if the ratings change meanwhile, the scores
+        # are tagged as older than they are and recomputed next time
+        version = self.ratings_version
+        if self.scores_version != version:
+            if np.any(self.user_ratings):
+                self.scores = self._user_scores(self.user_ratings, self.ratings)
+            else:
+                self.scores = np.zeros(len(self.user_ratings))
+            self.scores_version = version
+        return self.scores
+
     def _show_next_recommendation(self):
         """ 
         Given the user has completed 5 ratings, and the program is thus in 
@@ -343,6 +738,10 @@ class Chatbot:
         params: n/a
         returns: string including one recommendation for the user
         """
+        # Fetch the next page of recommendations once the current one is used up
+        if self.rec_index >= len(self.recommendations) and self.rec_cursor is not None:
+            self.recommendations.extend(self.rec_cursor.next_page(self.REC_PAGE_SIZE))
+
         # if there are recommendations to give, give recommendations       
         if self.rec_index < len(self.recommendations):
             next_idx = self.recommendations[self.rec_index]
@@ -356,6 +755,33 @@ class Chatbot:
             # Check "_select_response_variant" section 10. for output variations 
             return self._select_response_variant("out of recommendations", None, None, None)
             
+    def _generate_preamble(self, status):
+        """ Helper function for _select_response_variant
+        Use an llm call to write a short James Bond style preamble for a
+        response with the given status
+        """
+        system_prompt = """You are impersonating James Bond. Your task is to generate a short, witty preamble (one sentence) before the chatbot's main response.  
+
+        Guidelines: 
+            - Keep it short, sharp, and effortlessly cool. 
+            - The provided status will determine the tone and context.  
+            - The preamble should feel natural when followed by the main response. 
+            - Avoid unnecessary elaboration. James Bond is brief, confident, and slightly teasing.  
+
+        Examples: 
+            - Invalid Input (No Movie Title) -> A little precision goes a long way. Try again—with a movie in quotes. 
+            - Invalid Input (Multiple Movie Titles) -> Even MI6 doesn't handle this much intel at once. One movie at a time.
+            - Movie Not in Database -> Even I can't find what doesn't exist. Another title, perhaps?
+            - Neutral Movie Sentiment -> Not stirred by that film? Let's find something that truly shakes you. 
+            - Positive Movie Sentiment -> Ah, a film to your taste. I'll keep that in my mental dossier.
+            - Negative Movie Sentiment -> A regrettable experience, like warm champagne. Let's do better. 
+            - Recommending a Movie -> Trust me, this one's worth your timse. I have impeccable taste.
+            - Out of Recommendations -> Even I run out of intel. Give me more ratings, and we'll talk.
+            
+        Make sure the response you give is short. Maximum one sentence.'"""
+
+        return util.simple_llm_call(system_prompt, status, stop=["\n"])
+
     def _select_response_variant(self, status, curr_movie_title=None, found_movies_idx=None, recommended_movie_name=None):
         """
         For responses that have multiple variations, once the chatbot has specified 
@@ -364,28 +790,9 @@ class Chatbot:
         response = ""
 
         if self.llm_enabled:
-
-            system_prompt = """You are impersonating James Bond. Your task is to generate a short, witty preamble (one sentence) before the chatbot's main response.  
-
-            Guidelines: 
-                - Keep it short, sharp, and effortlessly cool. 
-                - The provided status will determine the tone and context.  
-                - The preamble should feel natural when followed by the main response. 
-                - Avoid unnecessary elaboration. James Bond is brief, confident, and slightly teasing.  
-
-            Examples: 
-                - Invalid Input (No Movie Title) -> A little precision goes a long way. Try again—with a movie in quotes. 
-                - Invalid Input (Multiple Movie Titles) -> Even MI6 doesn't handle this much intel at once. One movie at a time.
-                - Movie Not in Database -> Even I can't find what doesn't exist. Another title, perhaps?
-                - Neutral Movie Sentiment -> Not stirred by that film? Let's find something that truly shakes you. 
-                - Positive Movie Sentiment -> Ah, a film to your taste. I'll keep that in my mental dossier.
-                - Negative Movie Sentiment -> A regrettable experience, like warm champagne. Let's do better. 
-                - Recommending a Movie -> Trust me, this one's worth your timse. I have impeccable taste.
-                - Out of Recommendations -> Even I run out of intel. Give me more ratings, and we'll talk.
-                
-            Make sure the response you give is short. Maximum one sentence.'"""
-            
-            preamble = util.simple_llm_call(system_prompt, status, stop=["\n"])
+            # Preambles only depend on the status, so they are served from a
+            # pool that is generated in the background
+            preamble = self.preamble_pool.take(status)
             response += preamble  
 
         
@@ -582,7 +989,7 @@ class Chatbot:
         :returns: list of movie titles that are potentially in the text
         """
         
-        return re.findall(r'"([^"]+)"', preprocessed_input)
+        return TITLE_PATTERN.findall(preprocessed_input)
 
     def find_movies_by_title(self, title):
         """ Given a movie title, return a list of indices of matching movies.
@@ -605,12 +1012,13 @@ class Chatbot:
         
         # search movie with given title 
         result = self._search_movies(title)
-        if result != []:
+        if result != [] or not self.llm_enabled:
+            # Foreign titles are only detected and translated in LLM mode
             return result
         
         system_prompt = """You will respond return 0 if the user input is in English and 1 if it is in a foreign language. Do not include any additional information in your answer."""
         message = f"{title}"
-        response = util.simple_llm_call(system_prompt, message, stop=["\n"])
+        response = util.simple_llm_call(system_prompt, message, stop=["\n"], use_cache=True)
         is_foreign = bool(int(response))
 
         # if foreign title then we translaate it 
@@ -625,16 +1033,26 @@ class Chatbot:
         """Helper function for find_movies_by_title 
         Searches for movies in the database that match the given title 
         """
+        # check if input contains a 4-digit year in parentheses.
+        input_has_year = bool(re.search(r'\(\d{4}\)', title))
 
+        # Titles with a year are matched against database titles that keep
+        # only their year in parentheses, titles without one against database
+        # titles with every parenthesized part removed
+        index = self.title_index['with_year' if input_has_year else 'without_year']
+        return list(index.get(title.lower(), []))
+
+    @staticmethod
+    def _build_title_index(src_filename):
+        """Helper function for _search_movies
+        Reads the movie database once and maps the lowercase normalized forms
+        of every title to the indices of the movies with that title
+        """
         # Common articles for movie names 
-        title_lower = title.lower()
         articles = {"A", "An", "The"}
-        result = []
+        title_index = {'with_year': {}, 'without_year': {}}
 
-        # check if input contains a 4-digit year in parentheses.
-        input_has_year = bool(re.search(r'\(\d{4}\)', title))
-                
-        with open("data/movies.txt", "r") as file:
+        with open(src_filename, "r", encoding="utf-8") as file:
             for i, line in enumerate(file):
                 # Find movie title within % delimiter
                 title_start_idx = line.find('%')
@@ -656,24 +1074,19 @@ class Chatbot:
                     if possible_article in articles:
                         curr_movie = f"{possible_article} {curr_movie[:possible_article_idx]}{curr_movie[possible_article_end_idx:]}"
 
-                # if input has year, remove any parentheses between text and year 
-                if input_has_year:
-                    candidate_processed = re.sub(
-                        r'\(([^)]*)\)',
-                        lambda match: f"({match.group(1)})" if re.fullmatch(r'\d{4}', match.group(1)) else "",
-                        curr_movie
-                    ).strip()
-                    # compare candidate (including year) with the input
-                    if title_lower == candidate_processed.lower():
-                        result.append(i)
-
-                # if input has no year we remove all contents in parenthesis from the title in database
-                else:
-                    clean_title = re.sub(r'\([^)]*\)', '', curr_movie).strip()
-                    if title_lower == clean_title.lower():
-                        result.append(i)
+                # remove any parentheses between text and year, for inputs with a year
+                candidate_processed = re.sub(
+                    r'\(([^)]*)\)',
+                    lambda match: f"({match.group(1)})" if re.fullmatch(r'\d{4}', match.group(1)) else "",
+                    curr_movie
+                ).strip()
+                title_index['with_year'].setdefault(candidate_processed.lower(), []).append(i)
+
+                # remove all contents in parenthesis, for inputs without a year
+                clean_title = re.sub(r'\([^)]*\)', '', curr_movie).strip()
+                title_index['without_year'].setdefault(clean_title.lower(), []).append(i)
 
-        return result
+        return title_index
     
     def _translate_title(self, foreign_title):
         """ Helper function for find_movies_by_title
@@ -689,7 +1102,7 @@ class Chatbot:
         """The output you provide will be compared to titles in a database, so it is VERY important you match the format especifications outlined above."""
 
         # execute llm call and return response 
-        response = util.simple_llm_call(system_prompt, foreign_title, stop=["\n"])
+        response = util.simple_llm_call(system_prompt, foreign_title, stop=["\n"], use_cache=True)
 
         # remove any additional llm output 
         response = re.sub(r'\((?!\d{4}\))[^)]*\)', '', response)
@@ -697,20 +1110,6 @@ class Chatbot:
         # strip and return 
         return response.strip()
 
-    def load_sentiment_dictionary(self, src_filename: str, delimiter: str = ',', header: bool = False):
-        """Loads sentiment.txt and stores pre-stemmed words in a dictionary."""
-        sentiment_dict = {}
-        stemmer = PorterStemmer()
-
-        with open(src_filename, 'r') as f:
-            reader = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
-            if header:
-                next(reader)
-            for word, sentiment in reader:
-                sentiment_dict[stemmer.stem(word)] = sentiment
-
-        return sentiment_dict
-
     def extract_sentiment(self, preprocessed_input):
         """Extract a sentiment rating from a line of pre-processed text.
 
@@ -727,55 +1126,46 @@ class Chatbot:
         pre-processed with preprocess()
         :returns: a numerical value for the sentiment of the text
         """
-        # Convert input into list of lowercase words
-        preprocessed_input = preprocessed_input.lower()
-        movie_titles = self.extract_titles(preprocessed_input)
-
-        # Remove movie titles before sentiment analysis
-        for title in movie_titles:
-            preprocessed_input = preprocessed_input.replace(title.lower(), "")
-
-        # Convert input into list of words
-        words = preprocessed_input.split()
-
-        # Initialize sentiment score 
-        sentiment = 0
-
-        # Create an instance of the stemmer
-        stemmer = PorterStemmer()
-
-        # Setup Negation words
-        negation_words = {"not", "never", "no", "n't", "didn't", "doesn't", "isn't", "wasn't", 
-                        "shouldn't", "couldn't", "won't", "hadn't", "wouldn't", "don't", "can't"}
-        stemmed_negation_words = {stemmer.stem(word) for word in negation_words}
-
-        # Negation Flag 
-        Negation = False
-
-        for word in words:
-            stemmed_word = stemmer.stem(word)
-
-            # If negation word, do not use it for score and set negation flag
-            if stemmed_word in stemmed_negation_words:
-                Negation = True
-                continue
-
-            if stemmed_word in self.sentiment:
-                if self.sentiment[stemmed_word] == 'pos': 
-                    # Increase score for pos words or decrease if neg flag set
-                    sentiment += -1 if Negation  else 1  
-                elif self.sentiment[stemmed_word] == 'neg':
-                    # Decrease score for neg words or increase if neg flag set
-                    sentiment += 1 if Negation else -1 
-                Negation = False  # Reset negation after processing a sentiment word
-
-        # Determine output (1 if score is pos, -1 if score is neg, 0 otherwise)
-        if sentiment > 0: 
-            return 1
-        elif sentiment < 0: 
-            return -1
-        else: 
-            return 0
+        movie_titles = self.extract_titles(preprocessed_input.lower())
+        return score_sentiment(preprocessed_input, movie_titles,
+                               self.stemmer.stem, self.sentiment,
+                               self.negation_stems)
+
+    def extract_sentiment_batch(self, preprocessed_lines, processes=None,
+                                chunk_size=5000):
+        """Extract the sentiment of many lines of pre-processed text.
+
+        Returns the same -1/0/+1 values as calling extract_sentiment() on each
+        line. Large inputs are split into chunks scored by a pool of worker
+        processes, each with its own copy of the lexicon and stem cache.
+
+        :param preprocessed_lines: lines pre-processed with preprocess()
+        :param processes: number of worker processes; by default one per CPU
+        for inputs of at least BATCH_PROCESS_THRESHOLD lines, else none. 1
+        scores everything in this process with the shared stem cache.
+        :param chunk_size: number of lines sent to a worker at a time
+        :returns: list with the sentiment of each line
+        """
+        preprocessed_lines = list(preprocessed_lines)
+        if processes is None:
+            processes = (os.cpu_count() or 1
+                         if len(preprocessed_lines) >= BATCH_PROCESS_THRESHOLD
+                         else 1)
+        if processes <= 1:
+            stem, lexicon, negation_stems = (self.stemmer.stem, self.sentiment,
+                                             self.negation_stems)
+            return [score_sentiment(line, self.extract_titles(line.lower()),
+                                    stem, lexicon, negation_stems)
+                    for line in preprocessed_lines]
+
+        chunks = [preprocessed_lines[i:i + chunk_size]
+                  for i in range(0, len(preprocessed_lines), chunk_size)]
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_sentiment_worker,
+                                 initargs=(self.sentiment,
+                                           self.negation_stems)) as executor:
+            return [sentiment for chunk in executor.map(_score_sentiment_chunk, chunks)
+                    for sentiment in chunk]
 
     ############################################################################
     # 3. Movie Recommendation helper functions                                 #
@@ -794,7 +1184,7 @@ class Chatbot:
         any attributes of Chatbot like self.ratings in this method.
 
         :param ratings: a (num_movies x num_users) matrix of user ratings, from
-         0.5 to 5.0
+         0.5 to 5.0, either a numpy array or a scipy sparse matrix
         :param threshold: Numerical rating above which ratings are considered
         positive
 
@@ -809,6 +1199,16 @@ class Chatbot:
         # The starter code returns a new matrix shaped like ratings but full of
         # zeros.
         
+        # Sparse matrices only store the rated entries, so binarize those and
+        # keep the unrated entries implicit
+        if util.issparse(ratings):
+            binarized_ratings = ratings.tocsr(copy=True)
+            data = binarized_ratings.data
+            binarized_ratings.data = np.where(
+                data > threshold, 1.0, np.where(data > 0, -1.0, 0.0))
+            binarized_ratings.eliminate_zeros()
+            return binarized_ratings
+
         # copy original matrix to avoid editing self.ratings
         binarized_ratings = np.copy(ratings)
         
@@ -835,6 +1235,9 @@ class Chatbot:
         ########################################################################
         # TODO: Compute cosine similarity between the two vectors.             #
         ########################################################################
+        # Rows of self.ratings are int8; their products would overflow
+        u = np.asarray(u, dtype=float)
+        v = np.asarray(v, dtype=float)
         numerator = np.dot(u, v)
         denominator = np.linalg.norm(u) * np.linalg.norm(v)
         
@@ -848,7 +1251,108 @@ class Chatbot:
         ########################################################################
         return similarity
 
-    def recommend(self, user_ratings, ratings_matrix, k=10, llm_enabled=False):
+    @staticmethod
+    def normalize_rows(ratings_matrix, norms=None):
+        """Return a copy of ratings_matrix with every row scaled to unit length.
+
+        Rows whose norm is zero (movies nobody rated) are left as all zeros, so
+        their cosine similarity with any other movie is 0, like similarity().
+
+        :param ratings_matrix: a 2D numpy matrix of ratings (num_movies x
+         num_users), or a scipy sparse matrix
+        :param norms: the rows' L2 norms, if already known (e.g. from
+         util.load_row_norms())
+
+        :returns: a float matrix of the same shape with unit-norm rows, sparse
+         (CSR) if ratings_matrix was sparse
+        """
+        if norms is None:
+            norms = util.row_norms(ratings_matrix)
+        norms = np.asarray(norms, dtype=float)
+        if util.issparse(ratings_matrix):
+            import scipy.sparse
+
+            ratings_matrix = ratings_matrix.tocsr()
+            inverse = np.divide(1.0, norms, out=np.zeros_like(norms),
+                                where=norms > 0)
+            # Only the stored entries are scaled (kept float64, so sparse
+            # scores round like dense ones); the index arrays are shared
+            # with ratings_matrix
+            data = ratings_matrix.data * np.repeat(inverse,
+                                                   np.diff(ratings_matrix.indptr))
+            return scipy.sparse.csr_matrix(
+                (data, ratings_matrix.indices, ratings_matrix.indptr),
+                shape=ratings_matrix.shape, copy=False)
+
+        ratings_matrix = np.asarray(ratings_matrix, dtype=float)
+        norms = norms.reshape(-1, 1)
+        return np.divide(ratings_matrix, norms,
+                         out=np.zeros_like(ratings_matrix), where=norms > 0)
+
+    def _similarity_cache(self, normalized):
+        """Cosine similarities of one movie to every movie in normalized,
+        cached for the movies users rate most; shared by every session."""
+        return lru_cache(maxsize=self.SIMILARITY_CACHE_SIZE)(
+            partial(self._similarity_column, normalized))
+
+    @staticmethod
+    def _similarity_column(normalized, movie_idx):
+        """Cosine similarity of movie_idx to every movie, as a read-only
+        vector. Use the cached self.similarity_column() instead."""
+        column = normalized @ normalized[movie_idx].T
+        if util.issparse(column):
+            column = column.toarray()
+        column = np.asarray(column, dtype=float).ravel()
+        column.setflags(write=False)
+        return column
+
+    def recommendation_cursor(self, user_ratings, ratings_matrix, scores=None):
+        """Return a ranking.RankedCursor over every movie the user hasn't
+        rated, in the order recommend() returns them. Pages are ranked only
+        when requested, so asking for more recommendations never sorts the
+        whole catalog.
+
+        :param user_ratings: a binarized 1D numpy array of the user's movie
+            ratings
+        :param ratings_matrix: a binarized 2D numpy matrix (or scipy sparse
+          matrix) of all ratings
+        :param scores: optional precomputed scores, as for recommend()
+        :returns: a RankedCursor of movie indices
+        """
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        unrated = user_ratings == 0
+        if scores is None:
+            scores = self._user_scores(user_ratings, ratings_matrix)
+
+        # Rated movies are never recommended
+        return RankedCursor(np.round(scores, self.SCORE_DECIMALS),
+                            exclude=~unrated)
+
+    def _user_scores(self, user_ratings, ratings_matrix):
+        """sum_j cos(i, j) * user_ratings[j] for every movie i, from the
+        neighbor lists' candidates when scoring against self.ratings."""
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        if self.neighbors is not None and ratings_matrix is self.ratings:
+            # Score only the movies in a rated movie's neighbor list
+            return self.neighbors.user_scores(self.normalized_ratings,
+                                              user_ratings)
+
+        # Reuse the normalization computed at startup when scoring against
+        # the chatbot's own matrix; any other matrix is normalized on the fly.
+        if ratings_matrix is self.ratings:
+            normalized = self.normalized_ratings
+        else:
+            normalized = self.normalize_rows(ratings_matrix)
+
+        # sum_j cos(i, j) * r_j over the rated movies j, for every movie i
+        # at once: project the user's ratings into user space, then back
+        # onto every movie with a single matrix-vector product.
+        rated_idx = np.flatnonzero(user_ratings)
+        user_profile = normalized[rated_idx].T @ user_ratings[rated_idx]
+        return normalized @ user_profile
+
+    def recommend(self, user_ratings, ratings_matrix, k=10, llm_enabled=False,
+                  scores=None):
         """Generate a list of indices of movies to recommend using collaborative
          filtering.
 
@@ -862,10 +1366,14 @@ class Chatbot:
 
         :param user_ratings: a binarized 1D numpy array of the user's movie
             ratings
-        :param ratings_matrix: a binarized 2D numpy matrix of all ratings, where
-          `ratings_matrix[i, j]` is the rating for movie i by user j
+        :param ratings_matrix: a binarized 2D numpy matrix (or scipy sparse
+          matrix) of all ratings, where `ratings_matrix[i, j]` is the rating
+          for movie i by user j
         :param k: the number of recommendations to generate
         :param llm_enabled: whether the chatbot is in llm programming mode
+        :param scores: optional precomputed sum_j cos(i, j) * user_ratings[j]
+          for every movie i (see _rate_movie()), used instead of computing it
+          from ratings_matrix
 
         :returns: a list of k movie indices corresponding to movies in
         ratings_matrix, in descending order of recommendation.
@@ -884,38 +1392,71 @@ class Chatbot:
         # scores.                                                              #
         ########################################################################
 
-        # Populate this list with k movie indices to recommend to the user.
-        # Initialize variables: 
-        num_movies = ratings_matrix.shape[0]
-        predicted_ratings = np.zeros(num_movies)
-        
-        for i in range(num_movies):
-            # skip movies if rated by the user
-            if user_ratings[i] != 0:
-                continue 
-            
-            # initialize variables for calculating similarity 
-            score = 0.0
-                        
-            # iterate over every movie the user has rated
-            for j in range(num_movies):
-                # skip movies if not rated by the user
-                if user_ratings[j] == 0:
-                    continue
-                    
-                similarity = self.similarity(ratings_matrix[i],ratings_matrix[j])
-                score += similarity * user_ratings[j]
-            
-            predicted_ratings[i] = score + 1
-        
-        sorted_indices = np.argsort(predicted_ratings)[::-1]
-        recommendations = [i for i in sorted_indices if user_ratings[i] == 0][:k]
+        recommendations = self.recommendation_cursor(
+            user_ratings, ratings_matrix, scores=scores).next_page(k)
 
         ########################################################################
         #                        END OF YOUR CODE                              #
         ########################################################################
         return recommendations
 
+    def recommend_batch(self, user_ratings_matrix, ratings_matrix, k=10,
+                        chunk_size=256):
+        """Generate recommendations for many users at once.
+
+        Returns the same lists as calling recommend() on every user, but
+        scores a whole chunk of users with one pair of matrix products,
+        N @ (N.T @ R), where N is ratings_matrix with unit-norm rows and R
+        holds chunk_size users' ratings. Memory stays proportional to
+        num_movies x chunk_size.
+
+        :param user_ratings_matrix: a binarized (num_movies x num_profiles)
+          numpy matrix (or scipy sparse matrix), one column per user, like
+          ratings_matrix
+        :param ratings_matrix: a binarized 2D numpy matrix (or scipy sparse
+          matrix) of all ratings
+        :param k: the number of recommendations to generate per user
+        :param chunk_size: number of users scored per matrix product
+        :returns: list with a list of k movie indices for every user
+        """
+        num_profiles = user_ratings_matrix.shape[1]
+        if ratings_matrix is self.ratings and self.neighbors is not None:
+            # Neighbor mode scores each user's own candidates
+            return [self.recommend(
+                        self._profile_columns(user_ratings_matrix, user, user + 1)[:, 0],
+                        ratings_matrix, k=k)
+                    for user in range(num_profiles)]
+
+        if ratings_matrix is self.ratings:
+            normalized = self.normalized_ratings
+        else:
+            normalized = self.normalize_rows(ratings_matrix)
+        transposed = normalized.T
+
+        recommendations = []
+        for start in range(0, num_profiles, chunk_size):
+            stop = min(start + chunk_size, num_profiles)
+            profiles = self._profile_columns(user_ratings_matrix, start, stop)
+            scores = normalized @ (transposed @ profiles)
+            if util.issparse(scores):
+                scores = scores.toarray()
+            scores = np.round(np.asarray(scores), self.SCORE_DECIMALS)
+            for column in range(stop - start):
+                # Rated movies are never recommended
+                cursor = RankedCursor(scores[:, column],
+                                      exclude=profiles[:, column] != 0)
+                recommendations.append(cursor.next_page(k))
+        return recommendations
+
+    @staticmethod
+    def _profile_columns(user_ratings_matrix, start, stop):
+        """Columns [start, stop) of a user ratings matrix as a dense float
+        array."""
+        columns = user_ratings_matrix[:, start:stop]
+        if util.issparse(columns):
+            columns = columns.toarray()
+        return np.asarray(columns, dtype=float)
+
     ############################################################################
     # 4. PART 2: LLM Prompting Mode                                            #
     ############################################################################
@@ -1006,9 +1547,8 @@ class Chatbot:
         Possible emotions are: "Anger", "Disgust", "Fear", "Happiness", "Sadness", "Surprise"
         """
 
-        class EmotionExtractor(BaseModel):
-            emotions: list = Field(default_factory=list)
-        
+        EmotionExtractor = emotion_extractor_schema()
+
         system_prompt = """You are a highly capable, thoughtful, and precise emotion extractor bot. You only label text with emotions from this set: anger, disgust, fear, happiness, sadness, surprise.
 
         You will follow these guidelines carefully:
@@ -1030,7 +1570,7 @@ class Chatbot:
         """
 
         # llm call to get response 
-        response = util.json_llm_call(system_prompt, preprocessed_input, EmotionExtractor)
+        response = util.json_llm_call(system_prompt, preprocessed_input, EmotionExtractor, use_cache=True)
 
         # extract list of emotions from response 
         if hasattr(response, "emotions"):
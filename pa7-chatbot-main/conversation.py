@@ -0,0 +1,140 @@
+"""Per-conversation state for the chatbot.
+
+ChatSession holds everything specific to one user's conversation, so a single
+loaded Chatbot can serve many conversations (see Chatbot.for_session).
+
+ConversationHistory holds the messages sent to the LLM in prompting mode and
+keeps them within a token budget: the system prompt and the most recent turns
+are sent verbatim, while older turns are compacted into a short summary of the
+movies the user has given opinions on.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Rough number of characters per token for English chat text. Token counts
+# only need to be good enough to keep requests well under the context size.
+CHARS_PER_TOKEN = 4
+# Tokens the chat format adds around every message (role markers etc.)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+class ChatSession:
+    """The state of one user's conversation with the chatbot."""
+
+    def __init__(self, num_movies: int):
+        # The user's binarized rating for every movie (0 = not rated)
+        self.user_ratings = np.zeros(num_movies)
+        # Running sum_j cos(i, j) * user_ratings[j] for every movie i, kept
+        # in step with user_ratings by Chatbot._rate_movie()
+        self.scores = np.zeros(num_movies)
+        # Chatbot.ratings_version the scores were computed for
+        self.scores_version = 0
+        self.num_rated = 0
+        # Whether the chatbot has switched to giving recommendations
+        self.recommending = False
+        self.recommendations = []
+        self.rec_index = 0
+        # ranking.RankedCursor the next page of recommendations comes from
+        self.rec_cursor = None
+        self.curr_rec_count = 0
+        # ConversationHistory for LLM prompting mode, created on first use
+        self.llm_history = None
+
+
+def session_attribute(name: str) -> property:
+    """A property that reads and writes `name` on the object's session."""
+    return property(lambda self: getattr(self.session, name),
+                    lambda self, value: setattr(self.session, name, value),
+                    doc=f'ChatSession.{name} of the current session')
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate for a message's content."""
+    return MESSAGE_OVERHEAD_TOKENS + (len(text or '') + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def movie_opinions(chatbot, message: Dict) -> Dict[str, str]:
+    """Extract {title: opinion} facts from one user message.
+
+    Uses the chatbot's own title and sentiment extraction, so compaction
+    never needs an LLM call.
+    """
+    if message['role'] != 'user':
+        return {}
+    line = chatbot.preprocess(message['content'])
+    sentiment = chatbot.extract_sentiment(line)
+    opinion = {1: 'liked', -1: 'disliked'}.get(sentiment, 'mentioned')
+    return {title: opinion for title in chatbot.extract_titles(line)}
+
+
+class ConversationHistory:
+    """LLM message history bounded by a token budget.
+
+    When the messages would exceed max_tokens, the oldest turns (never the
+    system prompt or the last keep_recent messages) are dropped from the
+    verbatim history. Facts extracted from them by extract_facts are kept in
+    a summary message sent right after the system prompt. If summarize is
+    given, it is called once per compaction with the previous summary and the
+    dropped messages, and its result replaces the fact list.
+    """
+
+    def __init__(self, system_prompt: str, max_tokens: int = 2048,
+                 keep_recent: int = 6,
+                 extract_facts: Optional[Callable[[Dict], Dict[str, str]]] = None,
+                 summarize: Optional[Callable[[str, List[Dict]], str]] = None,
+                 max_facts: int = 50):
+        self.system_message = {"role": "system", "content": system_prompt}
+        self.max_tokens = max_tokens
+        self.keep_recent = keep_recent
+        self.extract_facts = extract_facts
+        self.summarize = summarize
+        self.max_facts = max_facts
+        self.recent = []
+        self.facts = OrderedDict()
+        self.summary = None
+
+    def append(self, role: str, content: str) -> None:
+        """Add a message and compact older turns if over the budget."""
+        self.recent.append({"role": role, "content": content})
+        self._compact()
+
+    def messages(self) -> List[Dict]:
+        """The list of messages to send to the LLM for the next turn."""
+        summary = self._summary_message()
+        prefix = [self.system_message] + ([summary] if summary else [])
+        return prefix + list(self.recent)
+
+    def num_tokens(self) -> int:
+        return sum(estimate_tokens(m['content']) for m in self.messages())
+
+    def _summary_message(self) -> Optional[Dict]:
+        if self.summary:
+            content = self.summary
+        elif self.facts:
+            opinions = ', '.join(f'{opinion} "{title}"'
+                                 for title, opinion in self.facts.items())
+            rated = sum(opinion != 'mentioned' for opinion in self.facts.values())
+            content = (f"Summary of the earlier conversation: the user has "
+                       f"given their opinion on {rated} movies so far "
+                       f"({opinions}).")
+        else:
+            return None
+        return {"role": "system", "content": content}
+
+    def _compact(self) -> None:
+        dropped = []
+        while (len(self.recent) > self.keep_recent
+               and self.num_tokens() > self.max_tokens):
+            message = self.recent.pop(0)
+            dropped.append(message)
+            if self.extract_facts is not None:
+                for title, opinion in self.extract_facts(message).items():
+                    # Keep the latest opinion, ordered by when it was given
+                    self.facts.pop(title, None)
+                    self.facts[title] = opinion
+            while len(self.facts) > self.max_facts:
+                self.facts.popitem(last=False)
+        if dropped and self.summarize is not None:
+            self.summary = self.summarize(self.summary or '', dropped)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""Append-only log of new ratings, applied to running chatbots in place.
+
+New (user, movie, rating) events are appended to data/ratings.delta.txt as
+user%movie%rating lines, like data/ratings.txt, instead of rewriting
+ratings.txt and restarting every process. A running Chatbot polls the log
+(Chatbot.refresh_ratings()) and applies the new events while it runs,
+recomputing only what they touch: the changed entries of the binarized
+matrix, the norms and normalized rows of the movies they belong to, and
+those movies' neighbor lists.
+
+Applying an event sets one (movie, user) entry, so replaying events that
+were already applied changes nothing. A process that starts, or crashes in
+the middle of a compaction, simply applies the whole log on top of the
+snapshot again.
+
+compact() folds the log back into the base data: its events are appended to
+ratings.txt, the updated matrix is written as the snapshot of the new
+ratings.txt, and the log starts again empty. The old log is kept as
+<log>.compacted, so processes that had not read it to the end yet can finish
+it; a process two compactions behind reloads the snapshot instead.
+
+Usage:
+  python3 delta_log.py append USER MOVIE RATING [USER MOVIE RATING ...]
+  python3 delta_log.py compact [--sparse_ratings]
+"""
+import argparse
+import logging
+import os
+import stat
+import warnings
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+
+import util
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends and compactions are not serialized
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DELTA_LOG_PATH = 'data/ratings.delta.txt'
+# server.py compacts the log once it grows past this many bytes
+COMPACT_BYTES = 16 << 20
+
+
+def _complete_lines(data: bytes) -> bytes:
+    """data up to its last newline; a line still being appended is left
+    for the next read."""
+    return data[:data.rfind(b'\n') + 1]
+
+
+def _format_events(users, movies, ratings, delimiter: str) -> bytes:
+    """user%movie%rating lines of the events, as in ratings.txt."""
+    return ''.join(delimiter.join((str(int(user)), str(int(movie)),
+                                   f'{float(rating):g}')) + '\n'
+                   for user, movie, rating in zip(users, movies, ratings)
+                   ).encode('ascii')
+
+
+def _read_from(path: str, offset: int) -> bytes:
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return _complete_lines(f.read())
+    except FileNotFoundError:
+        return b''
+
+
+class DeltaLog:
+    """Reader and writer of one delta log file.
+
+    A reader remembers the log's generation (the number of compactions so
+    far, kept in the lock file) and the offset of the first event it has
+    not returned yet, so read_new() only parses new events.
+    """
+
+    def __init__(self, path: str = DELTA_LOG_PATH, delimiter: str = '%'):
+        self.path = path
+        self.delimiter = delimiter
+        self.generation = None
+        self.offset = 0
+        # The lock file while this object holds the lock
+        self._lock_file = None
+
+    @property
+    def archive_path(self) -> str:
+        return self.path + '.compacted'
+
+    @contextmanager
+    def locked(self):
+        """Hold the log's lock, so the log is never appended to or read
+        while it is being compacted. Yields the lock file, which holds the
+        log's generation."""
+        if self._lock_file is not None:
+            # Already held, e.g. by compact() around read_new()
+            yield self._lock_file
+            return
+        with open(self.path + '.lock', 'a+') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._lock_file = lock_file
+            try:
+                yield lock_file
+            finally:
+                self._lock_file = None
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_generation(lock_file) -> int:
+        lock_file.seek(0)
+        text = lock_file.read().strip()
+        return int(text) if text else 0
+
+    def size(self) -> int:
+        """Bytes in the log, 0 if nothing was ever appended."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def start(self) -> None:
+        """Read the log from its first event on.
+
+        Call this before loading the ratings snapshot: if the log is
+        compacted in between, read_new() then still returns the compacted
+        events from the archive.
+        """
+        with self.locked() as lock_file:
+            self.generation = self._read_generation(lock_file)
+        self.offset = 0
+
+    def append(self, users, movies, ratings) -> None:
+        """Durably append (user, movie, rating) events to the log."""
+        lines = _format_events(users, movies, ratings, self.delimiter)
+        with self.locked():
+            with open(self.path, 'ab') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def read_new(self) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """(users, movies, ratings) of the events appended since the last
+        call, in log order.
+
+        :returns: None if the log was compacted more than once since the
+          last call, so events were lost to this reader; the ratings must
+          then be reloaded from the snapshot, which holds all of them
+        """
+        parts = []
+        with self.locked() as lock_file:
+            generation = self._read_generation(lock_file)
+            if self.generation is None:
+                self.generation = generation
+            if generation != self.generation:
+                lost = generation > self.generation + 1
+                if not lost:
+                    # Compacted once: finish reading the old log first
+                    parts.append(_read_from(self.archive_path, self.offset))
+                self.generation, self.offset = generation, 0
+                if lost:
+                    return None
+            data = _read_from(self.path, self.offset)
+        self.offset += len(data)
+        parts.append(data)
+        return util.parse_ratings_bytes(b''.join(parts), self.delimiter)
+
+
+def valid_events(users, movies, ratings, num_movies: int):
+    """The events whose movie exists and whose user id is non-negative."""
+    users = np.asarray(users, dtype=np.int64)
+    movies = np.asarray(movies, dtype=np.int64)
+    ratings = np.asarray(ratings, dtype=float)
+    valid = (users >= 0) & (movies >= 0) & (movies < num_movies)
+    if not np.all(valid):
+        logger.warning('Skipping %d rating events for unknown movies or users',
+                       np.count_nonzero(~valid))
+    return users[valid], movies[valid], ratings[valid]
+
+
+def _stored_positions(matrix, movies: np.ndarray, users: np.ndarray):
+    """Positions in a CSR matrix's data of its (movie, user) entries, or
+    None if one of them is not stored."""
+    if not matrix.has_sorted_indices:
+        return None
+    positions = np.empty(len(movies), dtype=np.int64)
+    for i, (movie, user) in enumerate(zip(movies, users)):
+        start, stop = matrix.indptr[movie], matrix.indptr[movie + 1]
+        position = start + np.searchsorted(matrix.indices[start:stop], user)
+        if position == stop or matrix.indices[position] != user:
+            return None
+        positions[i] = position
+    return positions
+
+
+def apply_events(matrix, users: np.ndarray, movies: np.ndarray,
+                 values: np.ndarray):
+    """Set matrix[movies, users] = values, the last value of a repeated
+    (movie, user) pair winning as in ratings.txt.
+
+    The events are written into matrix itself when it is writable (e.g. a
+    snapshot loaded with mmap_mode='c') and has room for them: a dense
+    matrix must have a column for every user, a CSR matrix must already
+    store every entry and no value may be 0. Otherwise they are applied to
+    a copy, widened for users the matrix has no column for yet.
+
+    :param matrix: dense or scipy CSR binarized ratings matrix
+    :param values: the events' binarized ratings
+    :returns: the updated matrix, matrix itself unless it had to be copied
+    """
+    if len(users) == 0:
+        return matrix
+    keep = util._last_occurrences(movies, users, int(users.max()) + 1)
+    movies, users, values = movies[keep], users[keep], values[keep]
+    num_users = max(matrix.shape[1], int(users.max()) + 1)
+
+    if util.issparse(matrix):
+        import scipy.sparse
+
+        if (num_users == matrix.shape[1] and matrix.data.flags.writeable
+                and np.all(values != 0)):
+            positions = _stored_positions(matrix, movies, users)
+            if positions is not None:
+                matrix.data[positions] = values
+                return matrix
+        matrix = matrix.copy()
+        if num_users > matrix.shape[1]:
+            matrix.resize((matrix.shape[0], num_users))
+        with warnings.catch_warnings():
+            # Inserting entries into a CSR matrix is expected here
+            warnings.simplefilter('ignore', scipy.sparse.SparseEfficiencyWarning)
+            matrix[movies, users] = values
+        matrix.eliminate_zeros()
+        return matrix
+
+    if num_users == matrix.shape[1] and matrix.flags.writeable:
+        matrix[movies, users] = values
+        return matrix
+    widened = np.zeros((matrix.shape[0], num_users), dtype=matrix.dtype)
+    widened[:, :matrix.shape[1]] = matrix
+    widened[movies, users] = values
+    return widened
+
+
+def compact(log: DeltaLog, refresh: Callable, title_list: List,
+            src_filename: str = 'data/ratings.txt',
+            titles_filename: str = 'data/movies.txt',
+            snapshot_dir: str = util.SNAPSHOT_DIR) -> int:
+    """Fold the log into ratings.txt and the ratings snapshot, then start
+    an empty log.
+
+    Only the events valid_events() accepts are written to ratings.txt, so
+    an event for an unknown movie can never break loading it.
+
+    :param log: the log, read up to where refresh() has applied it
+    :param refresh: applies the log's new events (see DeltaLog.read_new())
+      and returns the up-to-date binarized ratings matrix and its row norms
+      (None to compute them)
+    :param title_list: titles stored in the snapshot
+    :returns: number of bytes of events compacted
+    """
+    with log.locked() as lock_file:
+        # Nothing can be appended now, so this applies every event in the log
+        matrix, norms = refresh()
+        try:
+            with open(log.path, 'rb') as f:
+                logged = _complete_lines(f.read())
+        except FileNotFoundError:
+            return 0
+        if not logged:
+            return 0
+        events = _format_events(*valid_events(
+            *util.parse_ratings_bytes(logged, log.delimiter), len(title_list)),
+            log.delimiter)
+
+        # A crash from here on leaves the events in the log too; replaying
+        # them on top of the new ratings.txt changes nothing
+        mode = stat.S_IMODE(os.stat(src_filename).st_mode)
+
+        def write_ratings(f):
+            with open(src_filename, 'rb') as src:
+                data = src.read()
+            f.write(data)
+            if data and not data.endswith(b'\n'):
+                f.write(b'\n')
+            f.write(events)
+
+        util._atomic_write(src_filename, write_ratings)
+        os.chmod(src_filename, mode)
+        util.save_binarized_ratings(matrix, title_list, src_filename,
+                                    titles_filename, snapshot_dir, norms=norms)
+
+        # Keep the old log for readers that have not finished it yet
+        os.replace(log.path, log.archive_path)
+        open(log.path, 'ab').close()
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(log.generation + 1))
+        lock_file.flush()
+        log.generation, log.offset = log.generation + 1, 0
+        return len(logged)
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(
+        description='Appends ratings to the delta log or compacts it')
+    parser.add_argument('--log', default=DELTA_LOG_PATH,
+                        help='Delta log file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    append_parser = subparsers.add_parser('append', help='Appends rating events')
+    append_parser.add_argument('events', nargs='+', metavar='USER MOVIE RATING',
+                               help='Events as user id, movie id, rating triples')
+    compact_parser = subparsers.add_parser(
+        'compact', help='Folds the log into ratings.txt and its snapshot')
+    compact_parser.add_argument('--sparse_ratings', action='store_true', default=False,
+                                help='Compacts into the sparse (CSR) snapshot')
+    args = parser.parse_args()
+    if args.command == 'append' and len(args.events) % 3:
+        parser.error('events must be USER MOVIE RATING triples')
+    return args
+
+
+if __name__ == '__main__':
+    from chatbot import Chatbot
+
+    args = process_command_line()
+    log = DeltaLog(args.log)
+    if args.command == 'append':
+        fields = args.events
+        log.append(fields[0::3], fields[1::3], [float(r) for r in fields[2::3]])
+    else:
+        sources = {'ratings': 'data/ratings.txt', 'titles': 'data/movies.txt'}
+        log.start()
+        titles, ratings = util.load_binarized_ratings(
+            sources['ratings'], Chatbot.binarize,
+            titles_filename=sources['titles'], sparse=args.sparse_ratings,
+            mmap_mode='c')
+        state = {'ratings': ratings}
+
+        def refresh():
+            events = log.read_new()
+            if events is None:
+                _, state['ratings'] = util.load_binarized_ratings(
+                    sources['ratings'], Chatbot.binarize,
+                    titles_filename=sources['titles'], sparse=args.sparse_ratings,
+                    mmap_mode='c')
+                events = log.read_new()
+            users, movies, values = valid_events(*events, len(titles))
+            state['ratings'] = apply_events(state['ratings'], users, movies,
+                                            np.asarray(Chatbot.binarize(values)))
+            return state['ratings'], None
+
+        compacted = compact(log, refresh, titles, sources['ratings'],
+                            sources['titles'])
+        print(f'Compacted {compacted} bytes of events into {sources["ratings"]}')
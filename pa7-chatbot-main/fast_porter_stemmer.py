@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+"""Table-driven Porter stemmer.
+
+Produces exactly the same stems as porter_stemmer.PorterStemmer (including
+its points of --DEPARTURE-- from the published algorithm), but is written for
+speed rather than as a line-by-line port of the C reference:
+
+- A word's consonant/vowel pattern is computed once, as a string of 'c' and
+  'v' characters, and only the replaced tail is recomputed when a suffix
+  changes. The measure m() of a stem is then simply the number of "vc"
+  transitions in its pattern.
+- The suffix rules of steps 2, 3 and 4 are tables keyed by the letter the
+  reference implementation switches on, instead of chains of ends() calls.
+- There is no mutable per-word state, so stem() is a pure function that can
+  be shared between threads.
+"""
+
+import sys
+
+_VOWELS = 'aeiou'
+
+
+class _PatternTable(dict):
+    """str.translate() table mapping vowels to 'v' and anything else to 'c'.
+
+    'y' is mapped to 'c' here and fixed up by _pattern(), since whether it
+    acts as a vowel depends on the letter before it.
+    """
+
+    def __missing__(self, key):
+        return 'c'
+
+
+_PATTERN_TABLE = _PatternTable({ord(vowel): 'v' for vowel in _VOWELS})
+# The same mapping as a bytes.translate() table, for the common ASCII case
+_ASCII_PATTERN_TABLE = bytes(ord('v') if chr(byte) in _VOWELS else ord('c')
+                             for byte in range(256))
+
+# Step 2 and step 4 switch on the second-to-last letter, step 3 on the last.
+# Within a letter, the first suffix the word ends with is the one applied.
+_STEP2 = {
+    'a': (('ational', 'ate'), ('tional', 'tion')),
+    'c': (('enci', 'ence'), ('anci', 'ance')),
+    'e': (('izer', 'ize'),),
+    'l': (('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+          ('ousli', 'ous')),
+    'o': (('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate')),
+    's': (('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'),
+          ('ousness', 'ous')),
+    't': (('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble')),
+    'g': (('logi', 'log'),),
+}
+
+_STEP3 = {
+    'e': (('icate', 'ic'), ('ative', ''), ('alize', 'al')),
+    'i': (('iciti', 'ic'),),
+    'l': (('ical', 'ic'), ('ful', '')),
+    's': (('ness', ''),),
+}
+
+_STEP4 = {
+    'a': ('al',),
+    'c': ('ance', 'ence'),
+    'e': ('er',),
+    'i': ('ic',),
+    'l': ('able', 'ible'),
+    'n': ('ant', 'ement', 'ment', 'ent'),
+    'o': ('ion', 'ou'),
+    's': ('ism',),
+    't': ('ate', 'iti'),
+    'u': ('ous',),
+    'v': ('ive',),
+    'z': ('ize',),
+}
+
+
+def _pattern(chars, previous='v'):
+    """Consonant/vowel pattern of chars, given the pattern letter before them.
+
+    'y' is a consonant at the start of a word (previous defaults to 'v' for
+    that) or after a vowel, and a vowel after a consonant.
+    """
+    if chars.isascii():
+        pattern = chars.encode('ascii').translate(_ASCII_PATTERN_TABLE).decode('ascii')
+    else:
+        pattern = chars.translate(_PATTERN_TABLE)
+    if 'y' not in chars:
+        return pattern
+    fixed = []
+    for ch, kind in zip(chars, pattern):
+        if ch == 'y':
+            kind = 'c' if previous == 'v' else 'v'
+        fixed.append(kind)
+        previous = kind
+    return ''.join(fixed)
+
+
+def _replace_tail(word, pattern, stem_length, suffix):
+    """Replace everything after word[:stem_length] with suffix."""
+    stem_pattern = pattern[:stem_length]
+    return (word[:stem_length] + suffix,
+            stem_pattern + _pattern(suffix, stem_pattern[-1:] or 'v'))
+
+
+def _cvc(word, pattern, i):
+    """word[i-2:i+1] is consonant-vowel-consonant and word[i] isn't w, x or y."""
+    return (i >= 2 and pattern[i - 2:i + 1] == 'cvc'
+            and word[i] not in 'wxy')
+
+
+def stem(word):
+    """Return the Porter stem of a lowercase word."""
+    if len(word) <= 2:
+        return word  # --DEPARTURE-- (as in PorterStemmer)
+    pattern = _pattern(word)
+
+    # Step 1a: plurals
+    if word[-1] == 's':
+        if word.endswith('sses'):
+            word, pattern = word[:-2], pattern[:-2]
+        elif word.endswith('ies'):
+            word, pattern = _replace_tail(word, pattern, len(word) - 3, 'i')
+        elif word[-2] != 's':
+            word, pattern = word[:-1], pattern[:-1]
+
+    # Step 1b: -eed, -ed, -ing
+    cut = 0
+    last = word[-1]
+    if last == 'd':
+        if word.endswith('eed'):
+            if pattern[:-3].count('vc') > 0:
+                word, pattern = word[:-1], pattern[:-1]
+        elif word[-2:-1] == 'e':
+            cut = 2
+    elif last == 'g' and word.endswith('ing'):
+        cut = 3
+    if cut:
+        if 'v' in pattern[:-cut]:
+            word, pattern = word[:-cut], pattern[:-cut]
+            if word.endswith('at') or word.endswith('bl') or word.endswith('iz'):
+                word, pattern = _replace_tail(word, pattern, len(word), 'e')
+            elif (len(word) >= 2 and word[-1] == word[-2]
+                  and pattern[-1] == 'c'):
+                if word[-1] not in 'lsz':
+                    word, pattern = word[:-1], pattern[:-1]
+            elif pattern.count('vc') == 1 and _cvc(word, pattern, len(word) - 1):
+                word, pattern = _replace_tail(word, pattern, len(word), 'e')
+
+    # Step 1c: terminal y -> i when the stem has a vowel
+    if word[-1] == 'y' and 'v' in pattern[:-1]:
+        word, pattern = word[:-1] + 'i', pattern[:-1] + 'v'
+
+    # Step 2: double suffixes -> single ones, when m(stem) > 0
+    for suffix, replacement in _STEP2.get(word[-2:-1], ()):
+        if word.endswith(suffix):
+            stem_length = len(word) - len(suffix)
+            if pattern[:stem_length].count('vc') > 0:
+                word, pattern = _replace_tail(word, pattern, stem_length,
+                                              replacement)
+            break
+
+    # Step 3: -ic-, -full, -ness etc., when m(stem) > 0
+    for suffix, replacement in _STEP3.get(word[-1], ()):
+        if word.endswith(suffix):
+            stem_length = len(word) - len(suffix)
+            if pattern[:stem_length].count('vc') > 0:
+                word, pattern = _replace_tail(word, pattern, stem_length,
+                                              replacement)
+            break
+
+    # Step 4: -ant, -ence etc., when m(stem) > 1
+    for suffix in _STEP4.get(word[-2:-1], ()):
+        if word.endswith(suffix):
+            stem_length = len(word) - len(suffix)
+            if suffix == 'ion' and word[stem_length - 1:stem_length] not in ('s', 't'):
+                # -ion only counts after s or t; fall through to -ou
+                continue
+            if pattern[:stem_length].count('vc') > 1:
+                word, pattern = word[:stem_length], pattern[:stem_length]
+            break
+
+    # Step 5: final -e, and -ll -> -l, when the measure allows it
+    if word[-1] == 'e':
+        measure = pattern.count('vc')
+        if measure > 1 or (measure == 1
+                            and not _cvc(word, pattern, len(word) - 2)):
+            word, pattern = word[:-1], pattern[:-1]
+    if (word[-1] == 'l' and len(word) >= 2 and word[-2] == 'l'
+            and pattern.count('vc') > 1):
+        word = word[:-1]
+
+    return word
+
+
+class FastPorterStemmer:
+    """Drop-in replacement for porter_stemmer.PorterStemmer."""
+
+    def stem(self, p, i=None, j=None):
+        """Stem p[i..j] (the whole of p by default), like PorterStemmer.stem."""
+        if i is None:
+            i = 0
+        if j is None:
+            j = len(p) - 1
+        if j <= i + 1:
+            return p
+        return stem(p[i:j + 1])
+
+
+if __name__ == '__main__':
+    for f in sys.argv[1:]:
+        with open(f, 'r') as infile:
+            for line in infile:
+                print(' '.join(stem(word) for word in line.lower().split()))
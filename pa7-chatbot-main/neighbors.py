@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Top-N nearest neighbor lists for item-item collaborative filtering.
+
+Most of a movie's cosine similarities to the rest of the catalog are tiny or
+zero, so NeighborLists keeps only each movie's n_neighbors most similar movies
+(int32 indices and float32 scores). A recommendation then only considers the
+movies in the rated movies' lists, and scores each of those candidates
+exactly, so memory is proportional to n_neighbors x num_movies rather than
+num_movies squared and scoring to the number of candidates.
+
+Movies outside every rated movie's list are never recommended, although
+their exact score may beat a candidate's. On 200 profiles of 5-15 ratings
+drawn by movie popularity, recall@10 against exact recommend() was
+about 0.47 with 50 neighbors, 0.65 with 200 and 0.84 with 1000, taking 1.1,
+2.8 and 9.3 ms per profile against 4.6 ms for exact scoring.
+
+The lists are built once from the unit-normalized ratings matrix and saved
+under data/cache next to the ratings snapshot, as memory-mappable .npy files.
+
+Usage (prebuild the lists so the chatbot never has to):
+  python3 neighbors.py --neighbors 100 [--sparse_ratings]
+"""
+import argparse
+import os
+from typing import Dict, Optional
+
+import numpy as np
+
+import util
+
+# Rows of the similarity matrix computed at a time while building
+BUILD_BLOCK_SIZE = 512
+
+
+class NeighborLists:
+    """Every movie's most similar movies, best first.
+
+    indices[i] holds the n_neighbors movies most similar to movie i (never i
+    itself) and scores[i] their cosine similarities to it.
+    """
+
+    def __init__(self, indices: np.ndarray, scores: np.ndarray):
+        self.indices = indices
+        self.scores = scores
+
+    @property
+    def n_neighbors(self) -> int:
+        return self.indices.shape[1]
+
+    def __len__(self) -> int:
+        return self.indices.shape[0]
+
+    @classmethod
+    def build(cls, normalized, n_neighbors: int,
+              block_size: int = BUILD_BLOCK_SIZE) -> 'NeighborLists':
+        """Compute the lists from a matrix with unit-norm rows.
+
+        The similarity matrix is computed block_size rows at a time, so only
+        block_size x num_movies similarities are ever held in memory.
+
+        :param normalized: (num_movies x num_users) dense or scipy sparse
+          matrix with unit-norm rows, e.g. Chatbot.normalized_ratings
+        :param n_neighbors: number of neighbors to keep per movie
+        :param block_size: number of rows of similarities computed at a time
+        """
+        num_movies = normalized.shape[0]
+        n_neighbors = max(0, min(n_neighbors, num_movies - 1))
+        indices = np.empty((num_movies, n_neighbors), dtype=np.int32)
+        scores = np.empty((num_movies, n_neighbors), dtype=np.float32)
+        if n_neighbors == 0:
+            return cls(indices, scores)
+
+        transposed = normalized.T
+        for start in range(0, num_movies, block_size):
+            stop = min(start + block_size, num_movies)
+            similarities = normalized[start:stop] @ transposed
+            if util.issparse(similarities):
+                similarities = similarities.toarray()
+            similarities = np.asarray(similarities, dtype=float)
+            indices[start:stop], scores[start:stop] = _top_neighbors(
+                similarities, np.arange(start, stop), n_neighbors)
+        return cls(indices, scores)
+
+    def updated(self, normalized, movies) -> 'NeighborLists':
+        """Lists brought up to date after the rating vectors of the given
+        movies changed (see Chatbot.apply_rating_events()). These lists are
+        left as they are, so readers can keep using them meanwhile.
+
+        The changed movies' own lists are recomputed. In every other list a
+        changed movie's score is updated, or the movie replaces the least
+        similar neighbor if it now beats it. A neighbor whose score dropped
+        stays listed until the lists are rebuilt, since the movie that would
+        have taken its place is not known.
+
+        :param normalized: the updated matrix with unit-norm rows
+        :param movies: indices of the movies whose ratings changed
+        :returns: the updated lists, a new NeighborLists
+        """
+        movies = np.unique(np.asarray(movies, dtype=np.int64))
+        num_movies, n_neighbors = self.indices.shape
+        if n_neighbors == 0 or len(movies) == 0:
+            return self
+        indices, scores = np.array(self.indices), np.array(self.scores)
+
+        # (num_movies x len(movies)) similarities to the changed movies
+        similarities = normalized @ normalized[movies].T
+        if util.issparse(similarities):
+            similarities = similarities.toarray()
+        similarities = np.asarray(similarities, dtype=float)
+        changed = np.zeros(num_movies, dtype=bool)
+        changed[movies] = True
+
+        touched = np.zeros(num_movies, dtype=bool)
+        for column, movie in enumerate(movies):
+            movie_similarities = similarities[:, column]
+            rows, positions = np.nonzero(indices == movie)
+            listed = np.zeros(num_movies, dtype=bool)
+            listed[rows] = True
+            scores[rows, positions] = movie_similarities[rows]
+
+            worst = np.argmin(scores, axis=1)
+            gains = (~listed & ~changed
+                     & (movie_similarities > scores[np.arange(num_movies), worst]))
+            indices[gains, worst[gains]] = movie
+            scores[gains, worst[gains]] = movie_similarities[gains]
+            touched |= listed | gains
+
+        # Keep the updated lists best first
+        rows = np.flatnonzero(touched & ~changed)
+        order = np.argsort(-scores[rows], axis=1, kind='stable')
+        indices[rows] = np.take_along_axis(indices[rows], order, axis=1)
+        scores[rows] = np.take_along_axis(scores[rows], order, axis=1)
+
+        indices[movies], scores[movies] = _top_neighbors(
+            similarities.T.copy(), movies, n_neighbors)
+        return NeighborLists(indices, scores)
+
+    def candidates(self, movies) -> np.ndarray:
+        """Movies in at least one of the given movies' lists, ascending."""
+        return np.unique(self.indices[np.asarray(movies, dtype=np.int64)])
+
+    def user_scores(self, normalized, user_ratings: np.ndarray) -> np.ndarray:
+        """sum_j cos(i, j) * user_ratings[j] over the rated movies j, exact
+        for every candidate movie i (see candidates()); every other movie
+        scores -inf, so it ranks below all of them.
+
+        Costs O(candidates x num_users) instead of O(num_movies x num_users).
+
+        :param normalized: the matrix with unit-norm rows the lists were
+          built from
+        """
+        user_ratings = np.asarray(user_ratings, dtype=float)
+        rated_idx = np.flatnonzero(user_ratings)
+        candidates = self.candidates(rated_idx)
+        user_profile = normalized[rated_idx].T @ user_ratings[rated_idx]
+        scores = np.full(len(user_ratings), -np.inf)
+        scores[candidates] = normalized[candidates] @ user_profile
+        return scores
+
+    def save(self, base: str) -> None:
+        """Write the lists to base.indices.npy and base.scores.npy."""
+        for part in ('indices', 'scores'):
+            array = getattr(self, part)
+            util._atomic_write(f'{base}.{part}.npy',
+                               lambda f: np.save(f, array))
+
+    @classmethod
+    def load(cls, base: str, mmap_mode: Optional[str] = 'r') -> 'NeighborLists':
+        """Load lists written by save(), memory-mapped by default."""
+        return cls(*(np.load(f'{base}.{part}.npy', mmap_mode=mmap_mode)
+                     for part in ('indices', 'scores')))
+
+
+def _top_neighbors(similarities: np.ndarray, movies: np.ndarray,
+                   n_neighbors: int):
+    """(indices, scores) of the n_neighbors best entries of every row of
+    similarities, best first, where row r holds movie movies[r]'s
+    similarities to every movie. Overwrites each movie's own entry."""
+    rows = np.arange(len(movies))
+    # A movie is not its own neighbor
+    similarities[rows, movies] = -np.inf
+
+    # Pick the top n_neighbors of every row, then sort only those
+    top = np.argpartition(-similarities, n_neighbors - 1,
+                          axis=1)[:, :n_neighbors]
+    top_scores = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return (np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1))
+
+
+def _neighbors_paths(n_neighbors: int, snapshot_dir: str):
+    base = os.path.join(snapshot_dir,
+                        f'neighbors-v{util.SNAPSHOT_VERSION}-n{n_neighbors}')
+    return base, base + '.json'
+
+
+def load_neighbor_lists(normalized, n_neighbors: int, sources: Dict[str, str],
+                        snapshot_dir: str = util.SNAPSHOT_DIR,
+                        mmap_mode: Optional[str] = 'r',
+                        block_size: int = BUILD_BLOCK_SIZE) -> NeighborLists:
+    """Load the neighbor lists from data/cache, building them if needed.
+
+    Saved lists are reused as long as every source file the ratings matrix
+    was loaded from is unchanged (see util.fingerprint_matches()).
+
+    :param normalized: unit-normalized ratings matrix to build from on a miss
+    :param n_neighbors: number of neighbors per movie
+    :param sources: {name: path} of the files the ratings were loaded from
+    :param snapshot_dir: directory the lists are kept in
+    :param mmap_mode: mode passed to np.load() for the saved arrays
+    :param block_size: rows of similarities computed at a time when building
+    """
+    base, meta_path = _neighbors_paths(n_neighbors, snapshot_dir)
+    if util.read_snapshot_meta(meta_path, sources, n_neighbors=n_neighbors,
+                               num_movies=normalized.shape[0]):
+        try:
+            return NeighborLists.load(base, mmap_mode)
+        except (OSError, ValueError):
+            pass
+
+    neighbor_lists = NeighborLists.build(normalized, n_neighbors, block_size)
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        neighbor_lists.save(base)
+        util.write_snapshot_meta(meta_path, sources, n_neighbors=n_neighbors,
+                                 num_movies=normalized.shape[0])
+    except OSError:
+        return neighbor_lists
+    return NeighborLists.load(base, mmap_mode)
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(
+        description='Precompute every movie\'s top-N neighbor lists')
+    parser.add_argument('--neighbors', type=int, default=100,
+                        help='Number of neighbors to keep per movie')
+    parser.add_argument('--sparse_ratings', action='store_true', default=False,
+                        help='Computes similarities from the sparse (CSR) ratings matrix')
+    parser.add_argument('--block_size', type=int, default=BUILD_BLOCK_SIZE,
+                        help='Rows of the similarity matrix computed at a time')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from chatbot import Chatbot
+
+    args = process_command_line()
+    chatbot = Chatbot(sparse_ratings=args.sparse_ratings)
+    neighbor_lists = load_neighbor_lists(chatbot.normalized_ratings,
+                                         args.neighbors,
+                                         {'ratings': 'data/ratings.txt',
+                                          'titles': 'data/movies.txt'},
+                                         block_size=args.block_size)
+    print(f'{len(neighbor_lists)} movies x {neighbor_lists.n_neighbors} '
+          f'neighbors in {_neighbors_paths(args.neighbors, util.SNAPSHOT_DIR)[0]}.*.npy')
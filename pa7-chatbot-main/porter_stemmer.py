@@ -30,6 +30,8 @@ release 2: July 2008
 """
 
 import sys
+import threading
+from functools import lru_cache
 
 
 class PorterStemmer:
@@ -415,6 +417,29 @@ class PorterStemmer:
         return self.b[self.k0:self.k + 1]
 
 
+class CachingStemmer:
+    """A stemmer that remembers the stems of the words it has seen.
+
+    Stemming is a pure function of the word, and conversations keep using the
+    same few hundred words, so results are memoized in a bounded LRU cache.
+    By default words are stemmed with a PorterStemmer; since that keeps its
+    working state on the instance, cache misses are serialized with a lock
+    so one CachingStemmer is safe to share between threads. Pass a pure
+    stem_function (such as fast_porter_stemmer.stem) to skip the lock.
+    """
+
+    def __init__(self, max_entries=65536, stem_function=None):
+        if stem_function is None:
+            self._stemmer = PorterStemmer()
+            self._lock = threading.Lock()
+            stem_function = self._locked_stem
+        self.stem = lru_cache(maxsize=max_entries)(stem_function)
+
+    def _locked_stem(self, word):
+        with self._lock:
+            return self._stemmer.stem(word)
+
+
 if __name__ == '__main__':
     p = PorterStemmer()
     if len(sys.argv) > 1:
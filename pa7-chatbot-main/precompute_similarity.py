@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""Precompute the full item-item cosine similarity matrix on every core.
+
+For a large catalog the (num_movies x num_movies) similarity matrix does not
+fit in memory, so it is computed in blocks of rows by a pool of worker
+processes and written straight into a memory-mapped .npy file:
+
+- The unit-normalized ratings matrix is placed in shared memory once, and
+  every worker maps it instead of receiving its own pickled copy.
+- Each worker computes rows [start, stop) of the similarities and writes them
+  into the output file itself, so blocks never travel back through a pipe.
+- A done-mask file records every block that has been written and flushed. An
+  interrupted run picks up where it left off, as long as the ratings, the
+  block size and the output shape are unchanged.
+
+Usage:
+  python3 precompute_similarity.py [--workers 4] [--block_size 1024]
+
+The result can be opened with np.load(path, mmap_mode='r').
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import util
+
+SIMILARITY_PATH = os.path.join(util.SNAPSHOT_DIR,
+                               f'similarity-v{util.SNAPSHOT_VERSION}.npy')
+DEFAULT_BLOCK_SIZE = 1024
+
+# Shared memory blocks and output file of a worker process
+_worker_state = None
+
+
+def _share(array: np.ndarray, blocks: List) -> Dict:
+    """Copy array into a new shared memory block and describe it."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+    blocks.append(block)
+    return {'name': block.name, 'shape': array.shape, 'dtype': array.dtype.str}
+
+
+def _attach(descriptor: Dict, blocks: List) -> np.ndarray:
+    block = shared_memory.SharedMemory(name=descriptor['name'])
+    blocks.append(block)
+    return np.ndarray(descriptor['shape'], dtype=descriptor['dtype'],
+                      buffer=block.buf)
+
+
+def share_matrix(normalized, blocks: List) -> Dict:
+    """Describe a dense or CSR matrix placed in shared memory.
+
+    :param normalized: matrix to share, converted to float32
+    :param blocks: list the created SharedMemory blocks are appended to; the
+      caller must close and unlink them
+    """
+    if util.issparse(normalized):
+        normalized = normalized.tocsr()
+        return {'format': 'csr', 'shape': normalized.shape,
+                'data': _share(normalized.data.astype(np.float32), blocks),
+                'indices': _share(normalized.indices, blocks),
+                'indptr': _share(normalized.indptr, blocks)}
+    return {'format': 'dense', 'shape': normalized.shape,
+            'data': _share(np.asarray(normalized, dtype=np.float32), blocks)}
+
+
+def attach_matrix(descriptor: Dict, blocks: List):
+    """Map a matrix described by share_matrix() without copying it."""
+    if descriptor['format'] != 'csr':
+        return _attach(descriptor['data'], blocks)
+
+    import scipy.sparse
+
+    return scipy.sparse.csr_matrix(
+        tuple(_attach(descriptor[part], blocks)
+              for part in ('data', 'indices', 'indptr')),
+        shape=descriptor['shape'], copy=False)
+
+
+def _init_worker(descriptor: Dict, output_path: str) -> None:
+    global _worker_state
+    blocks = []
+    normalized = attach_matrix(descriptor, blocks)
+    output = np.load(output_path, mmap_mode='r+')
+    # Keep the SharedMemory objects alive as long as the arrays using them
+    _worker_state = (normalized, normalized.T.tocsr()
+                     if util.issparse(normalized) else normalized.T,
+                     output, blocks)
+
+
+def _compute_block(start: int, stop: int) -> int:
+    """Write similarity rows [start, stop) into the output file."""
+    normalized, transposed, output, _ = _worker_state
+    similarities = normalized[start:stop] @ transposed
+    if util.issparse(similarities):
+        similarities = similarities.toarray()
+    output[start:stop] = similarities
+    output.flush()
+    return start
+
+
+def _open_output(output_path: str, shape, block_size: int,
+                 sources: Dict[str, str]):
+    """Open (or create) the output file and its done-mask.
+
+    An existing partial run is resumed only if its metadata matches this one;
+    otherwise both files are recreated and every block is computed again.
+    """
+    base = os.path.splitext(output_path)[0]
+    done_path, meta_path = base + '.done.npy', base + '.json'
+    num_blocks = -(-shape[0] // block_size)
+    if util.read_snapshot_meta(meta_path, sources, shape=list(shape),
+                               block_size=block_size):
+        try:
+            done = np.load(done_path, mmap_mode='r+')
+            np.load(output_path, mmap_mode='r')
+            return done
+        except (OSError, ValueError):
+            pass
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32,
+                              shape=tuple(shape)).flush()
+    done = np.lib.format.open_memmap(done_path, mode='w+', dtype=bool,
+                                     shape=(num_blocks,))
+    done.flush()
+    util.write_snapshot_meta(meta_path, sources, shape=list(shape),
+                             block_size=block_size)
+    return done
+
+
+def precompute_similarity(normalized, sources: Dict[str, str],
+                          output_path: str = SIMILARITY_PATH,
+                          block_size: int = DEFAULT_BLOCK_SIZE,
+                          workers: Optional[int] = None,
+                          progress=sys.stderr) -> str:
+    """Compute every movie's cosine similarity to every movie.
+
+    :param normalized: (num_movies x num_users) dense or scipy sparse matrix
+      with unit-norm rows, e.g. Chatbot.normalized_ratings
+    :param sources: {name: path} of the files the ratings were loaded from,
+      used to tell whether a partial earlier run can be resumed
+    :param output_path: .npy file receiving the float32 similarity matrix
+    :param block_size: number of rows computed per task
+    :param workers: number of worker processes (default: one per CPU)
+    :param progress: stream progress lines are written to, or None
+    :returns: output_path
+    """
+    num_movies = normalized.shape[0]
+    done = _open_output(output_path, (num_movies, num_movies), block_size,
+                        sources)
+    pending = [block for block in range(len(done)) if not done[block]]
+    if progress is not None and len(pending) < len(done):
+        print(f'Resuming: {len(done) - len(pending)} of {len(done)} blocks '
+              f'already done', file=progress)
+
+    blocks = []
+    started = time.monotonic()
+    try:
+        descriptor = share_matrix(normalized, blocks)
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1,
+                                 initializer=_init_worker,
+                                 initargs=(descriptor, output_path)) as executor:
+            futures = {executor.submit(_compute_block, block * block_size,
+                                       min((block + 1) * block_size, num_movies)): block
+                       for block in pending}
+            for finished, future in enumerate(as_completed(futures), 1):
+                future.result()
+                # Only mark a block done once the worker has flushed it
+                done[futures[future]] = True
+                done.flush()
+                if progress is not None:
+                    elapsed = time.monotonic() - started
+                    remaining = elapsed / finished * (len(pending) - finished)
+                    print(f'\rblock {finished}/{len(pending)} '
+                          f'({100 * finished / len(pending):.0f}%), '
+                          f'{elapsed:.0f}s elapsed, ~{remaining:.0f}s left',
+                          end='', file=progress, flush=True)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    if progress is not None and pending:
+        print(file=progress)
+    return output_path
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(
+        description='Precompute the item-item cosine similarity matrix')
+    parser.add_argument('--output', default=SIMILARITY_PATH,
+                        help='.npy file to write the similarity matrix to')
+    parser.add_argument('--block_size', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help='Rows of the similarity matrix computed per task')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: one per CPU)')
+    parser.add_argument('--sparse_ratings', action='store_true', default=False,
+                        help='Shares the ratings with the workers in sparse (CSR) form')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    from chatbot import Chatbot
+
+    args = process_command_line()
+    sources = {'ratings': 'data/ratings.txt', 'titles': 'data/movies.txt'}
+    _, ratings = util.load_binarized_ratings(
+        sources['ratings'], Chatbot.binarize, titles_filename=sources['titles'],
+        sparse=args.sparse_ratings)
+    path = precompute_similarity(Chatbot.normalize_rows(ratings), sources,
+                                 output_path=args.output,
+                                 block_size=args.block_size,
+                                 workers=args.workers)
+    print(f'Wrote {path}')
@@ -0,0 +1,71 @@
+"""Top-k selection over score vectors without sorting every entry.
+
+top_k() picks the k best entries with np.argpartition and only sorts those k.
+RankedCursor pages through all entries in the same order, one page at a time,
+so asking for more recommendations never re-sorts the whole catalog.
+
+Entries are ordered by descending score. Ties are broken by descending index,
+the same order as reversing a stable ascending argsort.
+"""
+from typing import List, Optional
+
+import numpy as np
+
+
+def top_k(values: np.ndarray, k: int,
+          candidates: Optional[np.ndarray] = None) -> np.ndarray:
+    """Indices of the k largest values, best first.
+
+    :param values: 1D array of scores
+    :param k: number of indices to return (fewer if there aren't k candidates)
+    :param candidates: optional boolean mask of the entries that may be
+      returned; all entries by default
+    :returns: int array of at most k indices into values
+    """
+    indices = (np.arange(len(values)) if candidates is None
+               else np.flatnonzero(candidates))
+    candidate_values = values[indices]
+    if k <= 0 or len(indices) == 0:
+        return indices[:0]
+
+    if k < len(indices):
+        # Everything strictly better than the k-th best value is in, and the
+        # remaining places go to the highest indices tied with it
+        kth_value = -np.partition(-candidate_values, k - 1)[k - 1]
+        better = candidate_values > kth_value
+        tied = np.flatnonzero(candidate_values == kth_value)
+        keep = np.concatenate([np.flatnonzero(better),
+                               tied[len(tied) - (k - np.count_nonzero(better)):]])
+        indices, candidate_values = indices[keep], candidate_values[keep]
+
+    # Sort by value then index, both descending
+    order = np.lexsort((indices, candidate_values))[::-1]
+    return indices[order]
+
+
+class RankedCursor:
+    """Pages through the indices of a score vector from best to worst.
+
+    Each page costs one pass over the remaining entries plus sorting the page
+    itself, so only the pages actually requested are ever ranked.
+    """
+
+    def __init__(self, values: np.ndarray,
+                 exclude: Optional[np.ndarray] = None):
+        """
+        :param values: 1D array of scores; the cursor keeps its own copy
+        :param exclude: optional boolean mask of entries never to return
+        """
+        self.values = np.array(values, dtype=float)
+        self.remaining = (np.ones(len(self.values), dtype=bool) if exclude is None
+                          else ~np.asarray(exclude, dtype=bool))
+
+    def next_page(self, k: int) -> List[int]:
+        """The next k indices in ranked order (fewer once exhausted)."""
+        page = top_k(self.values, k, self.remaining)
+        self.remaining[page] = False
+        return page.tolist()
+
+    def __len__(self) -> int:
+        """Number of indices not returned yet."""
+        return int(np.count_nonzero(self.remaining))
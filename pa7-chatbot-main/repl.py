@@ -20,7 +20,9 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logging.DEBUG)
 
 from chatbot import Chatbot
-from util import load_together_client, stream_llm_to_console, DEFAULT_STOP
+from conversation import ConversationHistory, movie_opinions
+from delta_log import DELTA_LOG_PATH
+from util import load_together_client, stream_llm_to_console, DEFAULT_STOP, configure_llm_cache
 
 # Modular ASCII font from http://patorjk.com/software/taag/
 HEADER = """Welcome to Stanford CS124's
@@ -53,10 +55,16 @@ class REPL(cmd.Cmd):
     undoc_header = ''
     ruler = '-'
 
-    def __init__(self, llm_programming=False, llm_prompting=False):
+    def __init__(self, llm_programming=False, llm_prompting=False,
+                 sparse_ratings=False, neighbor_count=0, parse_workers=None,
+                 delta_log_path=None):
         super().__init__()
 
-        self.chatbot = Chatbot(llm_enabled=llm_programming)
+        self.chatbot = Chatbot(llm_enabled=llm_programming,
+                               sparse_ratings=sparse_ratings,
+                               neighbor_count=neighbor_count,
+                               parse_workers=parse_workers,
+                               delta_log_path=delta_log_path)
         self.name = self.chatbot.name
         self.bot_prompt = '\001\033[96m\002%s> \001\033[0m\002' % self.name
 
@@ -67,14 +75,12 @@ class REPL(cmd.Cmd):
         self.debug_chatbot = False
 
         self.llm_prompting = llm_prompting
-        self.llm_history = [{
-            "role": "system",
-            "content": self.chatbot.llm_system_prompt(),
-            },
-            {
-                "role": "assistant",
-                "content": self.greeting,
-            }]
+        # Keeps the system prompt and recent turns verbatim and compacts
+        # older turns into the movie opinions they contained
+        self.llm_history = ConversationHistory(
+            self.chatbot.llm_system_prompt(),
+            extract_facts=lambda message: movie_opinions(self.chatbot, message))
+        self.llm_history.append("assistant", self.greeting)
         self.llm_client = load_together_client()
 
     def cmdloop(self, intro=None):
@@ -109,6 +115,8 @@ class REPL(cmd.Cmd):
         elif self.llm_prompting:
             self.process_llm(line)
         else:
+            # Pick up ratings appended to the delta log since the last line
+            self.chatbot.refresh_ratings()
             response = self.chatbot.process(line)
             print(self.bot_says(response))
 
@@ -151,20 +159,14 @@ class REPL(cmd.Cmd):
         print(story)
 
     def process_llm(self, line):
-        self.llm_history.append({
-            "role": "user",
-            "content": line,
-        })
+        self.llm_history.append("user", line)
         print(self.bot_says(''), end="")
         response = stream_llm_to_console(
-            messages=self.llm_history,
+            messages=self.llm_history.messages(),
             client=self.llm_client,
             stop=DEFAULT_STOP,
         )
-        self.llm_history.append({
-            "role": "assistant",
-            "content": response,
-        })
+        self.llm_history.append("assistant", response)
 
 def process_command_line():
     parser = argparse.ArgumentParser(description=description)
@@ -172,6 +174,19 @@ def process_command_line():
                         default=False, help='Enables LLM programming mode')
     parser.add_argument('--llm_prompting', dest='llm_prompting', action='store_true',
                         default=False, help='Enables LLM prompting mode')
+    parser.add_argument('--llm_cache', dest='llm_cache', metavar='PATH',
+                        default=None, help='Persists cached classifier/translation LLM responses to this sqlite file')
+    parser.add_argument('--sparse_ratings', dest='sparse_ratings', action='store_true',
+                        default=False, help='Stores the ratings matrix in sparse (CSR) form')
+    parser.add_argument('--neighbors', dest='neighbors', type=int, metavar='N',
+                        default=0, help='Recommends only movies among the rated movies\' N nearest '
+                                        'neighbors. Approximate: recall@10 against exact scoring was '
+                                        'about 0.47 at N=50, 0.65 at N=200 and 0.84 at N=1000')
+    parser.add_argument('--parse_workers', dest='parse_workers', type=int, metavar='W',
+                        default=None, help='Processes parsing the ratings files when no snapshot exists')
+    parser.add_argument('--delta_log', dest='delta_log', metavar='PATH', nargs='?',
+                        const=DELTA_LOG_PATH, default=None,
+                        help='Applies new ratings from this delta log (default path: %s)' % DELTA_LOG_PATH)
     args = parser.parse_args()
     return args
 
@@ -207,5 +222,9 @@ if __name__ == '__main__':
     # END TESTING CODE      #
     #########################
     args = process_command_line()
-    repl = REPL(llm_prompting=args.llm_prompting, llm_programming=args.llm_programming)
+    if args.llm_cache:
+        configure_llm_cache(path=args.llm_cache)
+    repl = REPL(llm_prompting=args.llm_prompting, llm_programming=args.llm_programming,
+                sparse_ratings=args.sparse_ratings, neighbor_count=args.neighbors,
+                parse_workers=args.parse_workers, delta_log_path=args.delta_log)
     repl.cmdloop()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# PA7, CS124, Stanford
+#
+# Serves the chatbot to many users at once over HTTP. The Chatbot (ratings
+# matrix, titles, sentiment lexicon) is loaded once per process; every
+# conversation only gets its own lightweight ChatSession.
+#
+# Usage:
+#   python3 server.py [--llm_programming | --llm_prompting] [--port 8124]
+#       [--delta_log data/ratings.delta.txt]
+#
+# With --delta_log, ratings appended to the log (see delta_log.py) are
+# applied every --delta_poll seconds without a restart, and the log is
+# compacted into data/ratings.txt once it grows past --compact_bytes.
+#
+# API (JSON request and response bodies):
+#   POST   /sessions                 -> {"session_id": ..., "greeting": ...}
+#   POST   /sessions/<id>/messages   {"message": "..."} -> {"response": ...}
+#   DELETE /sessions/<id>            -> {"goodbye": ...}
+#   GET    /health                   -> {"sessions": <number of open sessions>}
+######################################################################
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from chatbot import Chatbot
+from delta_log import COMPACT_BYTES, DELTA_LOG_PATH
+from conversation import ConversationHistory, movie_opinions
+from util import call_llm, configure_llm_cache, load_together_client, DEFAULT_STOP
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+
+# Largest request body the server accepts, in bytes
+MAX_BODY_SIZE = 64 * 1024
+
+HTTP_REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request',
+                404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ChatServer:
+    """Routes HTTP requests to per-session views of one shared Chatbot."""
+
+    def __init__(self, chatbot, llm_prompting=False, workers=32,
+                 session_timeout=30 * 60):
+        self.chatbot = chatbot
+        self.llm_prompting = llm_prompting
+        self.session_timeout = session_timeout
+        # session id -> [Chatbot bound to the session, lock, last active time]
+        self.sessions = {}
+        # Chatbot.process() blocks on numpy and LLM calls, so it runs on
+        # worker threads instead of the event loop
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='chat')
+        self.llm_client = load_together_client() if llm_prompting else None
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, body, keep_alive = request
+                try:
+                    status, payload = await self.route(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception:
+                    logger.exception('Error handling %s %s', method, path)
+                    status, payload = 500, {'error': 'internal error'}
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except HTTPError as e:
+            self._write_response(writer, e.status, {'error': str(e)}, False)
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        parts = [part for part in path.split('?')[0].split('/') if part]
+        if parts == ['health'] and method == 'GET':
+            return 200, {'sessions': len(self.sessions)}
+        if parts == ['sessions'] and method == 'POST':
+            return 201, self.create_session()
+        if len(parts) >= 2 and parts[0] == 'sessions':
+            session_id = parts[1]
+            if session_id not in self.sessions:
+                raise HTTPError(404, f'unknown session {session_id}')
+            if len(parts) == 2 and method == 'DELETE':
+                self.sessions.pop(session_id)
+                return 200, {'goodbye': self.chatbot.goodbye()}
+            if parts[2:] == ['messages'] and method == 'POST':
+                message = self._parse_message(body)
+                response = await self.send_message(session_id, message)
+                return 200, {'response': response}
+            raise HTTPError(405, f'{method} not allowed on {path}')
+        raise HTTPError(404, f'no route for {path}')
+
+    def create_session(self):
+        session_id = uuid.uuid4().hex
+        session = self.chatbot.new_session()
+        greeting = self.chatbot.greeting()
+        if self.llm_prompting:
+            session.llm_history = ConversationHistory(
+                self.chatbot.llm_system_prompt(),
+                extract_facts=lambda message: movie_opinions(self.chatbot, message))
+            session.llm_history.append('assistant', greeting)
+        self.sessions[session_id] = [self.chatbot.for_session(session),
+                                     asyncio.Lock(), time.monotonic()]
+        return {'session_id': session_id, 'greeting': greeting}
+
+    async def send_message(self, session_id, message):
+        chatbot, lock, _ = self.sessions[session_id]
+        # One message at a time per conversation; different conversations run
+        # concurrently on the worker threads
+        async with lock:
+            self.sessions[session_id][2] = time.monotonic()
+            loop = asyncio.get_running_loop()
+            if self.llm_prompting:
+                return await loop.run_in_executor(
+                    self.executor, self._process_llm, chatbot.session, message)
+            return await loop.run_in_executor(self.executor, chatbot.process,
+                                              message)
+
+    def _process_llm(self, session, message):
+        # The turn only joins the history once the LLM has answered it, so a
+        # failed call leaves no unanswered message behind
+        messages = session.llm_history.messages() + [{'role': 'user',
+                                                      'content': message}]
+        response = call_llm(messages, self.llm_client, stop=DEFAULT_STOP)
+        session.llm_history.append('user', message)
+        session.llm_history.append('assistant', response)
+        return response
+
+    async def expire_sessions(self, interval=60):
+        """Drop conversations idle for longer than session_timeout."""
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - self.session_timeout
+            for session_id, (_, lock, last_active) in list(self.sessions.items()):
+                if last_active < cutoff and not lock.locked():
+                    self.sessions.pop(session_id, None)
+
+    async def refresh_ratings(self, interval=5, compact_bytes=COMPACT_BYTES):
+        """Apply the ratings appended to the chatbot's delta log, compacting
+        the log once it is larger than compact_bytes."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(self.executor, self._refresh_ratings,
+                                           compact_bytes)
+            except Exception:
+                logger.exception('Error applying the delta log')
+
+    def _refresh_ratings(self, compact_bytes):
+        applied = self.chatbot.refresh_ratings()
+        if applied:
+            logger.info('Applied %d new ratings', applied)
+        if self.chatbot.delta_log.size() >= compact_bytes:
+            self.chatbot.compact_ratings()
+
+    @staticmethod
+    def _parse_message(body):
+        try:
+            message = json.loads(body or b'{}').get('message')
+        except (ValueError, AttributeError):
+            raise HTTPError(400, 'body must be a JSON object')
+        if not isinstance(message, str):
+            raise HTTPError(400, 'body must contain a "message" string')
+        return message
+
+    @staticmethod
+    async def _read_request(reader):
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, path, version = request_line.decode('latin-1').split()
+        except ValueError:
+            raise HTTPError(400, 'malformed request line')
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            raise HTTPError(400, 'invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            raise HTTPError(413, 'request body too large')
+        body = await reader.readexactly(length) if length else b''
+        connection = headers.get('connection', '').lower()
+        keep_alive = (connection != 'close' if version == 'HTTP/1.1'
+                      else connection == 'keep-alive')
+        return method.upper(), path, body, keep_alive
+
+    @staticmethod
+    def _write_response(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode('utf-8')
+        head = (f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n')
+        writer.write(head.encode('latin-1') + body)
+
+
+async def serve(server, host, port, delta_poll=5, compact_bytes=COMPACT_BYTES):
+    tcp_server = await asyncio.start_server(server.handle_connection, host, port)
+    tasks = [asyncio.ensure_future(server.expire_sessions())]
+    if server.chatbot.delta_log is not None:
+        tasks.append(asyncio.ensure_future(
+            server.refresh_ratings(delta_poll, compact_bytes)))
+    print(f'Serving {server.chatbot.name} on http://{host}:{port}')
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def process_command_line():
+    parser = argparse.ArgumentParser(
+        description='HTTP server that holds many chatbot conversations at once')
+    parser.add_argument('--llm_programming', action='store_true', default=False,
+                        help='Enables LLM programming mode')
+    parser.add_argument('--llm_prompting', action='store_true', default=False,
+                        help='Enables LLM prompting mode')
+    parser.add_argument('--sparse_ratings', action='store_true', default=False,
+                        help='Stores the ratings matrix in sparse (CSR) form')
+    parser.add_argument('--neighbors', type=int, metavar='N', default=0,
+                        help='Recommends only movies among the rated movies\' N nearest '
+                             'neighbors. Approximate: recall@10 against exact scoring was '
+                             'about 0.47 at N=50, 0.65 at N=200 and 0.84 at N=1000')
+    parser.add_argument('--parse_workers', type=int, metavar='W', default=None,
+                        help='Processes parsing the ratings files when no snapshot exists')
+    parser.add_argument('--llm_cache', metavar='PATH', default=None,
+                        help='Persists cached classifier/translation LLM responses to this sqlite file')
+    parser.add_argument('--delta_log', metavar='PATH', nargs='?', const=DELTA_LOG_PATH,
+                        default=None, help='Applies new ratings from this delta log while serving')
+    parser.add_argument('--delta_poll', type=float, metavar='SECONDS', default=5,
+                        help='How often the delta log is checked for new ratings')
+    parser.add_argument('--compact_bytes', type=int, default=COMPACT_BYTES,
+                        help='Compacts the delta log into data/ratings.txt past this size')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8124)
+    parser.add_argument('--workers', type=int, default=32,
+                        help='Threads processing messages concurrently')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = process_command_line()
+    if args.llm_cache:
+        configure_llm_cache(path=args.llm_cache)
+    chatbot = Chatbot(llm_enabled=args.llm_programming,
+                      sparse_ratings=args.sparse_ratings,
+                      neighbor_count=args.neighbors,
+                      parse_workers=args.parse_workers,
+                      delta_log_path=args.delta_log)
+    chat_server = ChatServer(chatbot, llm_prompting=args.llm_prompting,
+                             workers=args.workers)
+    try:
+        asyncio.run(serve(chat_server, args.host, args.port,
+                          delta_poll=args.delta_poll,
+                          compact_bytes=args.compact_bytes))
+    except KeyboardInterrupt:
+        pass
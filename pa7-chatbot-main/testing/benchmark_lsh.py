@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# Measures the recall@k and latency of recommendations from a random-
+# hyperplane LSH index against exact recommend() for random user profiles,
+# over a grid of LSH settings.
+#
+# Each of the index's tables draws a number of random hyperplanes in user
+# space and hashes a movie to the side of each hyperplane its rating vector
+# lies on, so movies with a high cosine similarity tend to share a bucket in
+# at least one table. The movies sharing a bucket with a rated movie are the
+# candidates, and they are scored exactly.
+#
+# At this catalog's size the index does not pay off: exact scoring takes
+# about 4.5 ms per user, and every setting of the default grid that was
+# faster stayed at or below 0.36 recall@10. Hence the chatbot does not use
+# it; the index only lives here, so the result can be reproduced.
+#
+# Usage:
+#   python testing/benchmark_lsh.py [--users 200] [--k 10]
+#       [--tables 4 8 16] [--bits 6 8 10 12]
+######################################################################
+import argparse
+import inspect
+import os
+import sys
+import time
+
+import numpy as np
+
+currentdir = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from chatbot import Chatbot
+import util
+
+
+class HyperplaneLSH:
+    """Buckets of movies whose rating vectors point in similar directions.
+
+    For every table t, keys[t] is the sorted list of bucket keys and
+    order[t] the movie each key belongs to, so a bucket is a contiguous
+    slice found with np.searchsorted(). Movies nobody rated are not indexed.
+    """
+
+    def __init__(self, keys, order, movie_keys):
+        # (num_tables x num_indexed) sorted bucket keys and their movies
+        self.keys = keys
+        self.order = order
+        # (num_tables x num_movies) bucket key of every movie, -1 if unindexed
+        self.movie_keys = movie_keys
+
+    @classmethod
+    def build(cls, normalized, num_tables, num_bits, seed=0):
+        """Hash every movie's rating vector into num_tables tables of
+        num_bits hyperplanes each."""
+        num_movies, num_users = normalized.shape
+        rng = np.random.default_rng(seed)
+        planes = rng.standard_normal((num_tables, num_bits, num_users))
+
+        if util.issparse(normalized):
+            indexed = np.asarray(normalized.getnnz(axis=1)) > 0
+        else:
+            indexed = np.any(np.asarray(normalized) != 0, axis=1)
+        indexed_idx = np.flatnonzero(indexed)
+
+        weights = np.int64(1) << np.arange(num_bits, dtype=np.int64)
+        movie_keys = np.full((num_tables, num_movies), -1, dtype=np.int64)
+        keys = np.empty((num_tables, len(indexed_idx)), dtype=np.int64)
+        order = np.empty((num_tables, len(indexed_idx)), dtype=np.int64)
+        for table in range(num_tables):
+            # (num_movies x num_bits) side of every hyperplane, packed into bits
+            sides = np.asarray(normalized @ planes[table].T)[indexed_idx] > 0
+            table_keys = sides.astype(np.int64) @ weights
+            movie_keys[table, indexed_idx] = table_keys
+            by_key = np.argsort(table_keys, kind='stable')
+            keys[table] = table_keys[by_key]
+            order[table] = indexed_idx[by_key]
+        return cls(keys, order, movie_keys)
+
+    def candidates(self, movies):
+        """Movies sharing a bucket with one of the given movies in at least
+        one table, ascending."""
+        buckets = [np.empty(0, dtype=np.int64)]
+        for table in range(len(self.keys)):
+            for key in self.movie_keys[table, movies]:
+                if key >= 0:
+                    start, stop = np.searchsorted(self.keys[table], [key, key + 1])
+                    buckets.append(self.order[table, start:stop])
+        return np.unique(np.concatenate(buckets))
+
+    def user_scores(self, normalized, user_ratings):
+        """Exact scores of the rated movies' candidates; every other movie
+        scores -inf."""
+        rated_idx = np.flatnonzero(user_ratings)
+        candidates = self.candidates(rated_idx)
+        user_profile = normalized[rated_idx].T @ user_ratings[rated_idx]
+        scores = np.full(len(user_ratings), -np.inf)
+        scores[candidates] = normalized[candidates] @ user_profile
+        return scores
+
+
+def random_profiles(rating_counts, num_users, seed=0):
+    """Users rating 5-15 movies each, drawn like ratings.txt's popularity.
+
+    :param rating_counts: number of ratings of every movie in ratings.txt;
+      a movie is drawn with probability proportional to its count
+    """
+    rng = np.random.default_rng(seed)
+    num_movies = len(rating_counts)
+    popularity = rating_counts / rating_counts.sum()
+    profiles = np.zeros((num_users, num_movies))
+    for profile in profiles:
+        rated = rng.choice(num_movies, rng.integers(5, 16), replace=False,
+                           p=popularity)
+        profile[rated] = rng.choice([1, -1], len(rated))
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks an LSH index')
+    parser.add_argument('--users', type=int, default=200,
+                        help='Number of random user profiles')
+    parser.add_argument('--k', type=int, default=10,
+                        help='Number of recommendations compared per user')
+    parser.add_argument('--tables', type=int, nargs='+', default=[4, 8, 16])
+    parser.add_argument('--bits', type=int, nargs='+', default=[6, 8, 10, 12])
+    args = parser.parse_args()
+
+    os.chdir(parentdir)
+    chatbot = Chatbot()
+    normalized = chatbot.normalized_ratings
+    rating_counts = np.asarray((chatbot.ratings != 0).sum(axis=1),
+                               dtype=float).ravel()
+    profiles = random_profiles(rating_counts, args.users)
+
+    started = time.perf_counter()
+    exact = [set(chatbot.recommend(profile, chatbot.ratings, k=args.k))
+             for profile in profiles]
+    exact_ms = (time.perf_counter() - started) / len(profiles) * 1000
+    print('{} users, recall@{} against exact recommend() ({:.2f} ms/user)'
+          .format(args.users, args.k, exact_ms))
+    print('{:>6} {:>4} {:>10} {:>10} {:>10} {:>8}'.format(
+        'tables', 'bits', 'build (s)', 'candidates', 'ms/user', 'recall'))
+
+    for num_tables in args.tables:
+        for num_bits in args.bits:
+            started = time.perf_counter()
+            index = HyperplaneLSH.build(normalized, num_tables, num_bits)
+            build_s = time.perf_counter() - started
+
+            hits, candidates = 0, 0
+            started = time.perf_counter()
+            for profile, expected in zip(profiles, exact):
+                scores = index.user_scores(normalized, profile)
+                cursor = chatbot.recommendation_cursor(profile, chatbot.ratings,
+                                                       scores=scores)
+                hits += len(expected.intersection(cursor.next_page(args.k)))
+                candidates += np.count_nonzero(np.isfinite(scores))
+            query_ms = (time.perf_counter() - started) / len(profiles) * 1000
+            print('{:>6} {:>4} {:>10.2f} {:>10.0f} {:>10.2f} {:>8.3f}'.format(
+                num_tables, num_bits, build_s, candidates / len(profiles),
+                query_ms, hits / (args.k * len(profiles))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Times util.load_ratings() for each number of worker processes parsing the
+# file. ratings.txt is replicated with shifted user ids into a larger
+# synthetic file first, so every range is worth a process. Every run is
+# checked to produce the same matrix as a single process. Speedups only show
+# on a machine with several CPUs; none has been measured for this code yet,
+# which is why util.PARSE_WORKERS stays 1.
+#
+# Usage:
+#   python testing/benchmark_parse.py [--copies 20] [--workers 1 2 4 8]
+######################################################################
+import argparse
+import inspect
+import os
+import sys
+import tempfile
+import time
+
+currentdir = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import util
+
+
+def write_replicated_ratings(src_filename, dst_filename, copies):
+    """Write src_filename copies times, shifting the user ids of each copy."""
+    users, movies, ratings = util.parse_ratings(src_filename, workers=1)
+    num_users = int(users.max()) + 1
+    with open(dst_filename, 'w') as f:
+        for copy in range(copies):
+            lines = ['%d%%%d%%%s\n' % (user + copy * num_users, movie, rating)
+                     for user, movie, rating in zip(users.tolist(), movies.tolist(),
+                                                    ratings.tolist())]
+            f.writelines(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parallel ratings parsing')
+    parser.add_argument('--copies', type=int, default=20,
+                        help='Copies of ratings.txt in the synthetic file')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per worker count; the fastest one is reported')
+    parser.add_argument('--dense', action='store_true', default=False,
+                        help='Builds a dense matrix instead of a sparse (CSR) one')
+    args = parser.parse_args()
+
+    os.chdir(parentdir)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'ratings.txt')
+        write_replicated_ratings('data/ratings.txt', path, args.copies)
+        print('{:.1f} MB of ratings, {} CPUs'.format(
+            os.path.getsize(path) / 1e6, os.cpu_count()))
+        print('{:>7} {:>10} {:>8}'.format('workers', 'seconds', 'speedup'))
+
+        expected = baseline = None
+        for workers in args.workers:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                _, matrix = util.load_ratings(path, sparse=not args.dense,
+                                              workers=workers)
+                timings.append(time.perf_counter() - started)
+            if expected is None:
+                expected, baseline = matrix, min(timings)
+            elif matrix.shape != expected.shape or (matrix != expected).sum():
+                raise AssertionError('{} workers parsed a different matrix'.format(workers))
+            print('{:>7} {:>10.3f} {:>8.2f}'.format(
+                workers, min(timings), baseline / min(timings)))
+
+
+if __name__ == '__main__':
+    main()
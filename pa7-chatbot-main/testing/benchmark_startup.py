@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Measures the cold-start time of the chatbot in each mode, in a fresh
+# interpreter per run, using python -X importtime to break the time down by
+# imported module. Fails (exit status 1) if a mode is slower than
+# --max_seconds or imports a module it must not need, e.g. the LLM SDKs in
+# plain (non-LLM) mode.
+#
+# Usage:
+#   python testing/benchmark_startup.py [--repeat 3] [--max_seconds 2.0]
+######################################################################
+import argparse
+import inspect
+import os
+import re
+import subprocess
+import sys
+import time
+
+currentdir = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+
+# mode -> (code run in the fresh interpreter, modules it must not import)
+MODES = {
+    # python3 repl.py and testing/sanitycheck.py
+    'gus': ('import repl; repl.Chatbot()', ('openai', 'pydantic')),
+    # python3 server.py without LLM flags
+    'server': ('import server; server.Chatbot()', ('openai', 'pydantic')),
+    # The LLM SDKs loaded on first use by python3 repl.py --llm_programming
+    'llm': ('import repl, chatbot, util; chatbot.emotion_extractor_schema(); '
+            'import openai', ()),
+}
+
+IMPORTTIME_LINE = re.compile(
+    r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$')
+
+
+def run_mode(code):
+    """Run code in a fresh interpreter; return (seconds, {module: cumulative
+    import seconds})."""
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=parentdir, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    imports = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            _, cumulative, _, module = match.groups()
+            imports[module] = int(cumulative) / 1e6
+    return elapsed, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks chatbot start-up')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per mode; the fastest one is reported')
+    parser.add_argument('--max_seconds', type=float, default=None,
+                        help='Fail if the gus mode takes longer than this')
+    parser.add_argument('--top', type=int, default=8,
+                        help='Number of slowest packages to show')
+    parser.add_argument('modes', nargs='*', metavar='mode',
+                        help='Modes to run: {} (default: all)'.format(', '.join(MODES)))
+    args = parser.parse_args()
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error('unknown mode {!r}'.format(mode))
+
+    failed = False
+    for mode in args.modes or list(MODES):
+        code, forbidden = MODES[mode]
+        elapsed, imports = min((run_mode(code) for _ in range(args.repeat)),
+                               key=lambda run: run[0])
+        print('{}: {:.3f}s wall clock, {} modules imported'.format(
+            mode, elapsed, len(imports)))
+        # Import time of every top-level package, including its submodules
+        packages = sorted(((seconds, module) for module, seconds in imports.items()
+                           if '.' not in module), reverse=True)
+        for seconds, module in packages[:args.top]:
+            print('  {:8.3f}s  {}'.format(seconds, module))
+
+        unwanted = sorted(module for module in forbidden if module in imports)
+        if unwanted:
+            print('  FAIL: imports {}'.format(', '.join(unwanted)))
+            failed = True
+        if mode == 'gus' and args.max_seconds and elapsed > args.max_seconds:
+            print('  FAIL: slower than {:.3f}s'.format(args.max_seconds))
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
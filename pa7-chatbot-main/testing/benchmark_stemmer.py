@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# Compares the throughput of porter_stemmer.PorterStemmer and the
+# table-driven fast_porter_stemmer on the sentiment lexicon vocabulary.
+#
+# Usage:
+#   python testing/benchmark_stemmer.py [--repeat 5]
+######################################################################
+import argparse
+import inspect
+import os
+import sys
+import timeit
+
+currentdir = os.path.dirname(
+    os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from porter_stemmer import PorterStemmer
+import fast_porter_stemmer
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the stemmers')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed passes over the vocabulary')
+    args = parser.parse_args()
+
+    with open(os.path.join(parentdir, 'data', 'sentiment.txt')) as f:
+        words = [line.split(',')[0] for line in f]
+
+    reference = PorterStemmer()
+    stemmers = [
+        ('porter_stemmer.PorterStemmer', reference.stem),
+        ('fast_porter_stemmer.stem', fast_porter_stemmer.stem),
+    ]
+    print('{} words, best of {} passes'.format(len(words), args.repeat))
+    baseline = None
+    for name, stem in stemmers:
+        seconds = min(timeit.repeat(lambda: [stem(word) for word in words],
+                                    number=1, repeat=args.repeat))
+        baseline = baseline or seconds
+        print('{:32s} {:8.1f} ms  {:10.0f} words/s  {:5.1f}x'.format(
+            name, seconds * 1000, len(words) / seconds, baseline / seconds))
+
+
+if __name__ == '__main__':
+    main()
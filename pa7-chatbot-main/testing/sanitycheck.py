@@ -10,6 +10,9 @@ import inspect
 import os
 import sys
 import argparse
+import json
+import subprocess
+import tempfile
 import numpy as np
 import math
 
@@ -21,6 +24,8 @@ parentdir = os.path.dirname(currentdir)
 sys.path.insert(0, parentdir)
 
 from chatbot import Chatbot
+from porter_stemmer import PorterStemmer
+import fast_porter_stemmer
 
 
 def assert_numpy_array_equals(givenValue, correctValue, failureMessage):
@@ -228,10 +233,52 @@ def test_extract_sentiment():
                     input_text)
         ):
             tests_passed = False
+
+    # The batch API must agree with the single-line method, in and out of
+    # worker processes
+    lines = [chatbot.preprocess(input_text) for input_text, _ in test_cases]
+    expected = [chatbot.extract_sentiment(line) for line in lines]
+    for processes in (1, 2):
+        if not assert_list_equals(
+                chatbot.extract_sentiment_batch(lines, processes=processes),
+                expected,
+                "Incorrect output for extract_sentiment_batch() with "
+                "processes={}.".format(processes)
+        ):
+            tests_passed = False
     if tests_passed:
         print('extract_sentiment() sanity check passed!')
     print()
 
+def test_stemmer():
+    print("Testing fast_porter_stemmer against porter_stemmer...")
+    reference = PorterStemmer()
+
+    # Every word in the sentiment lexicon and in the test scripts
+    words = set()
+    with open(os.path.join(parentdir, 'data', 'sentiment.txt')) as f:
+        words.update(line.split(',')[0] for line in f)
+    scripts_dir = os.path.join(currentdir, 'test_scripts')
+    for root, _, files in os.walk(scripts_dir):
+        for name in files:
+            with open(os.path.join(root, name)) as f:
+                words.update(f.read().lower().split())
+
+    mismatches = [word for word in sorted(words)
+                  if fast_porter_stemmer.stem(word) != reference.stem(word)]
+    if mismatches:
+        print('fast_porter_stemmer.stem() differs from PorterStemmer.stem() '
+              'on {} of {} words'.format(len(mismatches), len(words)))
+        for word in mismatches[:10]:
+            print("  {!r}: expected {!r}, got {!r}".format(
+                word, reference.stem(word), fast_porter_stemmer.stem(word)))
+        print()
+        return False
+
+    print('stemmer sanity check passed!')
+    print()
+    return True
+
 def test_recommend():
     print("Testing recommend() functionality...")
     chatbot = Chatbot(False)
@@ -246,14 +293,59 @@ def test_recommend():
         [-1, -1, -1, 0],
     ])
     small_recommendations = chatbot.recommend(user_ratings, all_ratings, 2)
+    # Neighbor lists only pick the candidates; those are scored exactly
+    import neighbors
+    small_normalized = chatbot.normalize_rows(all_ratings)
+    small_exact = chatbot._user_scores(user_ratings, all_ratings)
+    small_neighbors = neighbors.NeighborLists.build(small_normalized, 1)
+    small_candidates = small_neighbors.candidates(np.flatnonzero(user_ratings))
+    neighbor_scores = small_neighbors.user_scores(small_normalized, user_ratings)
     user_ratings = np.zeros(9125)
     user_ratings[[8514, 7953, 6979, 7890]] = 1
     user_ratings[[7369, 8726]] = -1
     recommendations = chatbot.recommend(user_ratings, chatbot.ratings, k=5)
 
+    # The same ratings given one at a time, scored from the session's running
+    # scores instead of from scratch
+    for movie_idx in np.flatnonzero(user_ratings):
+        chatbot._rate_movie(movie_idx, user_ratings[movie_idx])
+    incremental_recommendations = chatbot.recommend(
+        chatbot.user_ratings, chatbot.ratings, k=5, scores=chatbot.scores)
+
+    cursor = chatbot.recommendation_cursor(user_ratings, chatbot.ratings)
+    # Several users scored together, one column each
+    batch_recommendations = chatbot.recommend_batch(
+        np.stack([user_ratings, -user_ratings], axis=1), chatbot.ratings, k=5)
+    negated_recommendations = chatbot.recommend(-user_ratings, chatbot.ratings, k=5)
+
+    # New ratings (one from a new user) applied in place: the running scores
+    # catch up on the next recommendation, and replaying them changes nothing
+    new_ratings = ([0, 1, chatbot.ratings.shape[1]], [8582, 8596, 8582], [1.0, 5.0, 4.5])
+    chatbot.apply_rating_events(*new_ratings)
+    updated_recommendations = chatbot.recommend(
+        chatbot.user_ratings, chatbot.ratings, k=5, scores=chatbot._session_scores())
+    chatbot.apply_rating_events(*new_ratings)
+    exact_updated_recommendations = chatbot.recommend(user_ratings, chatbot.ratings, k=5)
+    # Only the changed rows are renormalized, in place
+    normalized = chatbot.normalized_ratings
+    chatbot.apply_rating_events([2, 3], [8582, 10], [0.5, 4.0])
+    renormalized = chatbot.normalize_rows(chatbot.ratings)
+
     test_cases = [
         (small_recommendations, [2, 3]),
+        (np.allclose(neighbor_scores[small_candidates],
+                     small_exact[small_candidates]), True),
+        (np.isneginf(np.delete(neighbor_scores, small_candidates)).all(), True),
         (recommendations, [8582, 8596, 8786, 8309, 8637]),
+        (incremental_recommendations, [8582, 8596, 8786, 8309, 8637]),
+        # Paging through the ranking continues where the previous page ended
+        (cursor.next_page(2) + cursor.next_page(3),
+         [8582, 8596, 8786, 8309, 8637]),
+        (batch_recommendations[0], [8582, 8596, 8786, 8309, 8637]),
+        (batch_recommendations[1], negated_recommendations),
+        (updated_recommendations, exact_updated_recommendations),
+        (chatbot.normalized_ratings is normalized, True),
+        (np.allclose(chatbot.normalized_ratings, renormalized), True),
     ]
 
     tests_passed = True
@@ -268,6 +360,799 @@ def test_recommend():
         print('recommend() sanity check passed!')
     print()
 
+def test_ratings_loading():
+    print("Testing ratings loading and snapshots...")
+    import shutil
+    import util
+
+    checks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        ratings_path = os.path.join(tmp, 'ratings.txt')
+        titles_path = os.path.join(tmp, 'movies.txt')
+        cache_dir = os.path.join(tmp, 'cache')
+        shutil.copy(os.path.join(parentdir, 'data', 'ratings.txt'), ratings_path)
+        shutil.copy(os.path.join(parentdir, 'data', 'movies.txt'), titles_path)
+
+        def parsed():
+            titles, ratings = util.load_ratings(ratings_path,
+                                                titles_filename=titles_path)
+            return titles, Chatbot.binarize(ratings)
+
+        def load(**kwargs):
+            return util.load_binarized_ratings(ratings_path, Chatbot.binarize,
+                                               titles_path, cache_dir, **kwargs)
+
+        # A snapshot round-trip gives what a fresh parse does, row norms
+        # included
+        titles, expected = parsed()
+        built_titles, built = load()
+        snapshot_path = os.path.join(cache_dir, 'ratings-v{}.npy'.format(
+            util.SNAPSHOT_VERSION))
+        built_at = os.stat(snapshot_path).st_mtime_ns
+        loaded_titles, loaded = load()
+        checks.append((isinstance(loaded, np.memmap), True))
+        checks.append((built_titles == loaded_titles == titles, True))
+        checks.append((np.array_equal(built, expected), True))
+        checks.append((np.array_equal(loaded, expected), True))
+        checks.append((np.allclose(util.load_row_norms(ratings_path, titles_path,
+                                                       cache_dir),
+                                   util.row_norms(expected)), True))
+
+        # A moved mtime with the same contents reuses the snapshot
+        stat = os.stat(ratings_path)
+        os.utime(ratings_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        _, loaded = load()
+        checks.append((os.stat(snapshot_path).st_mtime_ns, built_at))
+        checks.append((np.array_equal(loaded, expected), True))
+
+        # Changed contents (even of the same size) force a rebuild
+        with open(ratings_path, 'r+b') as f:
+            first_line = f.readline()
+            f.seek(0)
+            # User 0 rated movie 30 2.5; make it 4.5
+            f.write(first_line.replace(b'%2.5', b'%4.5', 1))
+        os.utime(ratings_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+        checks.append((os.path.getsize(ratings_path), stat.st_size))
+        _, changed = parsed()
+        checks.append((np.array_equal(changed, expected), False))
+        _, loaded = load()
+        checks.append((np.array_equal(loaded, changed), True))
+        with open(ratings_path, 'a') as f:
+            f.write('\n0%0%0.5\n')
+        _, changed = parsed()
+        _, loaded = load()
+        checks.append((np.array_equal(loaded, changed), True))
+        checks.append((np.allclose(util.load_row_norms(ratings_path, titles_path,
+                                                       cache_dir),
+                                   util.row_norms(changed)), True))
+
+        # The sparse (CSR) matrices hold the same ratings as the dense ones
+        _, raw = util.load_ratings(ratings_path, titles_filename=titles_path)
+        _, sparse_raw = util.load_ratings(ratings_path, sparse=True,
+                                          titles_filename=titles_path)
+        checks.append((util.issparse(sparse_raw), True))
+        checks.append((np.array_equal(sparse_raw.toarray(), raw), True))
+        load(sparse=True)
+        _, sparse = load(sparse=True)
+        checks.append((util.issparse(sparse), True))
+        checks.append((np.array_equal(sparse.toarray(), changed), True))
+        checks.append((np.allclose(util.load_row_norms(ratings_path, titles_path,
+                                                       cache_dir, sparse=True),
+                                   util.row_norms(changed)), True))
+        checks.append((np.allclose(Chatbot.normalize_rows(sparse).toarray(),
+                                   Chatbot.normalize_rows(changed)), True))
+        chatbot = Chatbot(False)
+        user_ratings = np.zeros((changed.shape[0], 2))
+        user_ratings[[8514, 7953, 6979, 7890], 0] = 1
+        user_ratings[[7369, 8726, 30], 1] = -1
+        user_ratings[[0, 1], 1] = 1
+        checks.append(([chatbot.recommend(profile, sparse, k=5)
+                        for profile in user_ratings.T],
+                       [chatbot.recommend(profile, changed, k=5)
+                        for profile in user_ratings.T]))
+        checks.append((chatbot.recommend_batch(user_ratings, sparse, k=5),
+                       chatbot.recommend_batch(user_ratings, changed, k=5)))
+
+        # The bulk parser agrees with a per-line one and rejects bad lines
+        with open(ratings_path, 'rb') as f:
+            data = f.read()
+        fields = [line.split('%') for line in data.decode('ascii').split('\n')
+                  if line]
+        users, movies, ratings = util.parse_ratings_bytes(data)
+        checks.append((users.tolist(), [int(line[0]) for line in fields]))
+        checks.append((movies.tolist(), [int(line[1]) for line in fields]))
+        checks.append((ratings.tolist(),
+                       np.float32([float(line[2]) for line in fields]).tolist()))
+        for malformed in [b'0%1%2.5\n0%1\n', b'0%1%2.5\n0%x%2.5\n']:
+            try:
+                util.parse_ratings_bytes(malformed)
+                checks.append((malformed, ValueError))
+            except ValueError:
+                pass
+
+        # Parsing in several processes gives what a single one does
+        min_range_bytes = util.MIN_PARSE_RANGE_BYTES
+        util.MIN_PARSE_RANGE_BYTES = 1 << 16
+        try:
+            ranges = util.line_ranges(ratings_path, 3)
+            checks.append((len(ranges), 3))
+            checks.append(([start for start, _ in ranges[1:]],
+                           [stop for _, stop in ranges[:-1]]))
+            checks.append((ranges[0][0], 0))
+            checks.append((ranges[-1][1], len(data)))
+            checks.append(([data[start - 1:start] for start, _ in ranges[1:]],
+                           [b'\n'] * 2))
+            single = util.parse_ratings(ratings_path, workers=1)
+            multi = util.parse_ratings(ratings_path, workers=3)
+            checks.append(([np.array_equal(a, b) for a, b in zip(single, multi)],
+                           [True] * 3))
+            checks.append((util.load_titles(titles_path, workers=3),
+                           util.load_titles(titles_path, workers=1)))
+        finally:
+            util.MIN_PARSE_RANGE_BYTES = min_range_bytes
+
+        # Streaming ingestion builds the CSR matrix load_ratings() does,
+        # whatever the chunk size and number of workers
+        ingest_dir = os.path.join(tmp, 'ingest')
+        expected = Chatbot.binarize(sparse_raw)
+        for chunk_bytes, workers in [(1 << 16, 1), (1 << 18, 2), (1 << 30, 1)]:
+            ingested_titles, ingested = util.ingest_ratings(
+                ratings_path, Chatbot.binarize, titles_path, ingest_dir,
+                chunk_bytes=chunk_bytes, workers=workers)
+            checks.append((ingested_titles == titles, True))
+            checks.append((ingested.shape, expected.shape))
+            checks.append(((ingested - expected).nnz, 0))
+            checks.append((np.allclose(util.load_row_norms(ratings_path,
+                                                           titles_path,
+                                                           ingest_dir,
+                                                           sparse=True),
+                                       util.row_norms(expected)), True))
+
+        # A repeated (movie, user) pair keeps its last rating, and a rating
+        # of an unknown movie is rejected
+        repeated_path = os.path.join(tmp, 'repeated.txt')
+        with open(repeated_path, 'w') as f:
+            f.write('0%1%4.5\n1%1%1.0\n0%1%0.5\n1%2%3.0\n1%1%5.0\n')
+        _, repeated = util.ingest_ratings(repeated_path, Chatbot.binarize,
+                                          titles_path, ingest_dir,
+                                          chunk_bytes=8)
+        checks.append((repeated[[1, 2]].toarray().tolist(),
+                       [[-1, 1], [0, 1]]))
+        with open(repeated_path, 'a') as f:
+            f.write('0%{}%4.5\n'.format(len(titles)))
+        try:
+            util.ingest_ratings(repeated_path, Chatbot.binarize, titles_path,
+                                ingest_dir)
+            checks.append(('unknown movie', ValueError))
+        except ValueError:
+            pass
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for ratings loading tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('ratings loading sanity check passed!')
+    print()
+    return tests_passed
+
+def test_score_profiles():
+    print("Testing score_profiles.py...")
+    script = os.path.join(parentdir, 'score_profiles.py')
+
+    def score(lines, *options):
+        completed = subprocess.run(
+            [sys.executable, script, '-k', '3'] + list(options),
+            input=''.join(lines), capture_output=True, text=True,
+            cwd=parentdir)
+        return [json.loads(line) for line in completed.stdout.splitlines()]
+
+    # "300" is a title, "#1359" a movie id; a bad line or row only fails
+    # its own profile
+    jsonl_results = score([
+        '{"user": "a", "ratings": {"300": 1, "#1359": -1}}\n',
+        'not json\n',
+        '{"user": "b", "ratings": [[true, 1], [6654, 1]]}\n',
+    ])
+    csv_results = score([
+        'user,movie,rating\n',
+        'x,Titanic (1997)\n',
+        'y,#1359,5\n',
+    ], '--format', 'csv')
+    # Batches of any size give the same records
+    batched_results = score([
+        '{"user": "a", "ratings": {"300": 1, "#1359": -1}}\n',
+        'not json\n',
+        '{"user": "b", "ratings": [[true, 1], [6654, 1]]}\n',
+    ], '--batch_size', '2')
+
+    # A batch recommends what recommend() does for each of its profiles
+    import score_profiles
+    chatbot = Chatbot(False)
+    scorer = score_profiles.ProfileScorer(chatbot, k=3)
+    profiles = [('p', [('#8514', 1), ('#7953', 1), ('#30', -1)], None),
+                ('q', [('#6979', 1)], None),
+                ('r', [], None)]
+    expected_recommendations = []
+    for _, ratings, _ in profiles:
+        user_ratings, _ = scorer.user_ratings(ratings)
+        expected_recommendations.append(
+            chatbot.recommend(user_ratings, chatbot.ratings, k=3)
+            if np.any(user_ratings) else [])
+
+    test_cases = [
+        ([result['user'] for result in jsonl_results], ['a', 2, 'b']),
+        (jsonl_results[0]['unresolved'], []),
+        (['error' in result for result in jsonl_results], [False, True, False]),
+        (jsonl_results[2]['unresolved'], [True]),
+        ([result['user'] for result in csv_results], ['x', 'y']),
+        (['error' in result for result in csv_results], [True, False]),
+        (len(csv_results[1]['recommendations']), 3),
+        (batched_results, jsonl_results),
+        ([[movie['id'] for movie in result['recommendations']]
+          for result in scorer(profiles)], expected_recommendations),
+    ]
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(test_cases):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for score_profiles.py tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('score_profiles.py sanity check passed!')
+    print()
+    return tests_passed
+
+def test_delta_log():
+    print("Testing the delta log...")
+    import delta_log
+    import neighbors
+    import util
+
+    checks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        ratings_path = os.path.join(tmp, 'ratings.txt')
+        titles_path = os.path.join(tmp, 'movies.txt')
+        cache_dir = os.path.join(tmp, 'cache')
+        with open(titles_path, 'w') as f:
+            f.writelines('{0}%Movie {0} (2000)%Drama\n'.format(i) for i in range(6))
+        with open(ratings_path, 'w') as f:
+            f.write('0%0%4.0\n0%1%1.0\n1%1%5.0\n1%2%2.0\n')
+        titles, matrix = util.load_binarized_ratings(
+            ratings_path, Chatbot.binarize, titles_path, snapshot_dir=cache_dir)
+        state = {'matrix': matrix}
+
+        def refresh(log):
+            def apply():
+                events = log.read_new()
+                if events is None:
+                    _, state['matrix'] = util.load_binarized_ratings(
+                        ratings_path, Chatbot.binarize, titles_path,
+                        snapshot_dir=cache_dir)
+                    events = log.read_new()
+                users, movies, values = delta_log.valid_events(*events, len(titles))
+                state['matrix'] = delta_log.apply_events(
+                    state['matrix'], users, movies,
+                    np.asarray(Chatbot.binarize(values)))
+                return state['matrix'], None
+            return apply
+
+        log_path = os.path.join(tmp, 'ratings.delta.txt')
+        writer, reader, lagging = (delta_log.DeltaLog(log_path) for _ in range(3))
+        for log in (writer, reader, lagging):
+            log.start()
+
+        # A line still being appended is left for the next read
+        writer.append([2, 3], [3, 4], [4.5, 1.0])
+        with open(log_path, 'a') as f:
+            f.write('4%5')
+        users, movies, _ = reader.read_new()
+        checks.append((list(movies), [3, 4]))
+        checks.append((reader.offset, len('2%3%4.5\n3%4%1\n')))
+        with open(log_path, 'a') as f:
+            f.write('%3.5\n')
+        checks.append((list(reader.read_new()[0]), [4]))
+
+        # Compacting writes only the valid events (movie 9 does not exist)
+        writer.append([5], [9], [4.0])
+        writer.append([6], [0], [1.0])
+        compacted = delta_log.compact(writer, refresh(writer), titles,
+                                      ratings_path, titles_path, cache_dir)
+        with open(ratings_path) as f:
+            lines = f.read().splitlines()
+        checks.append((lines[4:], ['2%3%4.5', '3%4%1', '4%5%3.5', '6%0%1']))
+        checks.append((compacted > 0, True))
+        _, reloaded = util.load_binarized_ratings(
+            ratings_path, Chatbot.binarize, titles_path, snapshot_dir=cache_dir)
+        checks.append((np.array_equal(reloaded, state['matrix']), True))
+        checks.append((np.array_equal(
+            util.load_row_norms(ratings_path, titles_path, cache_dir),
+            util.row_norms(reloaded)), True))
+
+        # One compaction behind: the rest of the old log comes from its
+        # archive, followed by the new log
+        writer.append([7], [1], [5.0])
+        checks.append((list(reader.read_new()[0]), [5, 6, 7]))
+
+        # Two compactions behind: the reader must reload the snapshot
+        delta_log.compact(writer, refresh(writer), titles, ratings_path,
+                          titles_path, cache_dir)
+        checks.append((lagging.read_new(), None))
+        checks.append((len(lagging.read_new()[0]), 0))
+
+    # Events are written into the matrix itself unless it must grow, or a
+    # CSR matrix must store a new entry
+    import scipy.sparse
+    dense = np.array([[1, 0], [-1, 1]], dtype=np.int8)
+    applied = delta_log.apply_events(dense, np.array([0]), np.array([1]), np.array([1]))
+    checks.append((applied is dense, True))
+    checks.append((dense.tolist(), [[1, 0], [1, 1]]))
+    grown = delta_log.apply_events(dense, np.array([2]), np.array([0]), np.array([-1]))
+    checks.append((grown is dense, False))
+    checks.append((grown.tolist(), [[1, 0, -1], [1, 1, 0]]))
+    csr = scipy.sparse.csr_matrix(dense)
+    applied = delta_log.apply_events(csr, np.array([1]), np.array([1]), np.array([-1]))
+    checks.append((applied is csr, True))
+    inserted = delta_log.apply_events(csr, np.array([1]), np.array([0]), np.array([1]))
+    checks.append((inserted is csr, False))
+    checks.append((inserted.toarray().tolist(), [[1, 1], [1, -1]]))
+
+    # Updating neighbor lists matches rebuilding them for the changed movies
+    rng = np.random.default_rng(0)
+    before = rng.choice([-1, 0, 0, 1], size=(40, 30)).astype(float)
+    after = before.copy()
+    changed = np.array([3, 17, 25])
+    after[changed] = rng.choice([-1, 0, 0, 1], size=(len(changed), 30))
+    before, after = Chatbot.normalize_rows(before), Chatbot.normalize_rows(after)
+
+    updated = neighbors.NeighborLists.build(before, 5).updated(after, changed)
+    rebuilt = neighbors.NeighborLists.build(after, 5)
+    checks.append((np.array_equal(updated.indices[changed], rebuilt.indices[changed]), True))
+    similarities = after @ after.T
+    checks.append((np.allclose(updated.scores, np.take_along_axis(
+        similarities, updated.indices.astype(np.int64), axis=1)), True))
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for delta log tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('delta log sanity check passed!')
+    print()
+    return tests_passed
+
+def test_server():
+    print("Testing server.py...")
+    import asyncio
+    import delta_log
+    import server
+
+    checks = []
+
+    async def request(port, method, path, payload=None):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        writer.write('{} {} HTTP/1.1\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(method, path, len(body))
+                     .encode('latin-1') + body)
+        response = await reader.read()
+        writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), json.loads(body)
+
+    async def run(chat_server, log):
+        tcp_server = await asyncio.start_server(chat_server.handle_connection,
+                                                '127.0.0.1', 0)
+        port = tcp_server.sockets[0].getsockname()[1]
+        async with tcp_server:
+            # Sessions are created, routed to and deleted independently
+            status, created = await request(port, 'POST', '/sessions')
+            checks.append((status, 201))
+            checks.append((bool(created['greeting']), True))
+            _, other = await request(port, 'POST', '/sessions')
+            checks.append((await request(port, 'GET', '/health'),
+                           (200, {'sessions': 2})))
+            session_id = created['session_id']
+            status, replied = await request(
+                port, 'POST', '/sessions/{}/messages'.format(session_id),
+                {'message': 'I liked "Titanic (1997)"'})
+            checks.append((status, 200))
+            checks.append((isinstance(replied['response'], str), True))
+            checks.append(([int(chat_server.sessions[key][0].num_rated)
+                            for key in (session_id, other['session_id'])], [1, 0]))
+
+            # Bad requests get their status code
+            checks.append(((await request(port, 'POST', '/sessions/{}/messages'
+                                          .format(session_id), {'text': 1}))[0], 400))
+            checks.append(((await request(port, 'POST', '/sessions/nope/messages',
+                                          {'message': 'hi'}))[0], 404))
+            checks.append(((await request(port, 'GET',
+                                          '/sessions/' + session_id))[0], 405))
+
+            status, deleted = await request(port, 'DELETE', '/sessions/' + session_id)
+            checks.append((status, 200))
+            checks.append((deleted, {'goodbye': chat_server.chatbot.goodbye()}))
+            checks.append((await request(port, 'GET', '/health'),
+                           (200, {'sessions': 1})))
+
+        # Idle sessions expire, unless a message is being processed
+        busy = chat_server.create_session()['session_id']
+        lock = chat_server.sessions[busy][1]
+        await lock.acquire()
+        chat_server.session_timeout = 0
+        expiry = asyncio.ensure_future(chat_server.expire_sessions(interval=0))
+        await asyncio.sleep(0.05)
+        expiry.cancel()
+        lock.release()
+        checks.append((list(chat_server.sessions), [busy]))
+
+        # New ratings in the delta log are applied; past compact_bytes the
+        # log is compacted
+        chatbot = chat_server.chatbot
+        version = chatbot.ratings_version
+        log.append([0], [8582], [1.0])
+        compacted = []
+        chatbot.compact_ratings = lambda: compacted.append(True)
+        chat_server._refresh_ratings(compact_bytes=1 << 30)
+        checks.append((chatbot.ratings_version, version + 1))
+        checks.append((int(chatbot.ratings[8582, 0]), -1))
+        checks.append((len(compacted), 0))
+        chat_server._refresh_ratings(compact_bytes=1)
+        checks.append((len(compacted), 1))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, 'ratings.delta.txt')
+        chatbot = Chatbot(False, delta_log_path=log_path)
+        chat_server = server.ChatServer(chatbot, workers=2)
+        asyncio.run(run(chat_server, delta_log.DeltaLog(log_path)))
+
+        # In LLM prompting mode, a turn whose LLM call failed is not kept
+        # in the history
+        chat_server.llm_prompting = True
+        session_id = chat_server.create_session()['session_id']
+        history = chat_server.sessions[session_id][0].session.llm_history
+
+        def failing_call(messages, client, stop=None):
+            raise ConnectionError('LLM unavailable')
+
+        def echoing_call(messages, client, stop=None):
+            return 'You said: ' + messages[-1]['content']
+
+        call_llm = server.call_llm
+        try:
+            server.call_llm = failing_call
+            try:
+                asyncio.run(chat_server.send_message(session_id, 'hello'))
+            except ConnectionError:
+                pass
+            checks.append(([message['role'] for message in history.recent],
+                           ['assistant']))
+            server.call_llm = echoing_call
+            checks.append((asyncio.run(chat_server.send_message(session_id, 'hi')),
+                           'You said: hi'))
+            checks.append(([message['role'] for message in history.recent],
+                           ['assistant', 'user', 'assistant']))
+        finally:
+            server.call_llm = call_llm
+        chat_server.executor.shutdown()
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for server.py tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('server.py sanity check passed!')
+    print()
+    return tests_passed
+
+def fake_llm_client(respond):
+    """A stand-in for the Together client whose chat completions are
+    respond(messages); returns (client, list of the messages of every call)."""
+    from types import SimpleNamespace
+
+    calls = []
+
+    def create(messages, **kwargs):
+        calls.append(messages)
+        message = SimpleNamespace(content=respond(messages))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    completions = SimpleNamespace(create=create)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions)), calls
+
+def test_llm_cache():
+    print("Testing the LLM response cache...")
+    import time
+    import util
+
+    checks = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # The in-memory LRU keeps the max_entries most recently used
+        cache = util.LLMResponseCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        checks.append(([cache.get(key) for key in 'abc'], [1, None, 3]))
+
+        # Responses survive in sqlite across instances, up to max_disk_entries
+        path = os.path.join(tmp, 'llm_cache.sqlite')
+        writer = util.LLMResponseCache(path=path, max_disk_entries=2)
+        for key, value in (('x', 'one'), ('y', {'two': [2]}), ('z', 'three')):
+            writer.put(key, value)
+            time.sleep(0.01)
+        reader = util.LLMResponseCache(path=path)
+        checks.append(([reader.get(key) for key in 'xyz'],
+                       [None, {'two': [2]}, 'three']))
+
+        # Entries older than ttl are misses, in memory and on disk
+        expiring = util.LLMResponseCache(path=path, ttl=0.05)
+        expiring.put('t', 'soon gone')
+        checks.append((expiring.get('t'), 'soon gone'))
+        time.sleep(0.1)
+        checks.append((expiring.get('t'), None))
+        checks.append((util.LLMResponseCache(path=path).get('t'), None))
+
+    # Only use_cache=True calls are answered from the cache
+    client, calls = fake_llm_client(lambda messages: 'yes')
+    load_together_client, shared_cache = util.load_together_client, util.llm_cache
+    try:
+        util.load_together_client = lambda: client
+        util.configure_llm_cache()
+        responses = [util.simple_llm_call('system', 'message', use_cache=True)
+                     for _ in range(2)]
+        checks.append((len(calls), 1))
+        responses += [util.simple_llm_call('system', 'message') for _ in range(2)]
+        checks.append((len(calls), 3))
+        checks.append((responses, ['yes'] * 4))
+    finally:
+        util.load_together_client, util.llm_cache = load_together_client, shared_cache
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for LLM response cache tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('LLM response cache sanity check passed!')
+    print()
+    return tests_passed
+
+def test_llm_pool():
+    print("Testing the LLM response pool...")
+    import itertools
+    import threading
+    import time
+    import util
+
+    checks = []
+    counter = itertools.count()
+    state = {'fail': False}
+    generated = []
+    # Background generation waits for this, so the first take() finds the
+    # pool empty
+    background_started = threading.Event()
+
+    def generate(key):
+        thread = threading.current_thread()
+        if thread is not threading.main_thread():
+            background_started.wait(5)
+        generated.append((key, thread.name, thread.daemon))
+        if state['fail']:
+            raise ConnectionError('LLM unavailable')
+        return '{}-{}'.format(key, next(counter))
+
+    def pooled(pool, key):
+        with pool._lock:
+            return len(pool._responses[key])
+
+    def wait_until(condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    pool = util.LLMResponsePool(generate, ['a', 'b'], size=2, low_water=1)
+    # Nothing is generated before the first take()
+    time.sleep(0.05)
+    checks.append((list(generated), []))
+
+    # The first take() generates its response synchronously, while daemon
+    # threads fill every key in the background
+    first = pool.take('a')
+    checks.append((generated[0][1], threading.current_thread().name))
+    background_started.set()
+    checks.append((wait_until(lambda: pooled(pool, 'a') == 2
+                              and pooled(pool, 'b') == 2), True))
+    checks.append(({(name, daemon) for _, name, daemon in generated[1:]},
+                   {('llm-pool', True)}))
+
+    # Later takes are served from the pool, which is topped back up
+    count = len(generated)
+    taken = [pool.take('b'), pool.take('b')]
+    checks.append((len(set([first] + taken)), 3))
+    checks.append((wait_until(lambda: pooled(pool, 'b') == 2), True))
+    checks.append((all(name == 'llm-pool' for _, name, _ in generated[count:]), True))
+
+    # Failed background calls leave the pool short; once it is empty, take()
+    # generates synchronously and its error reaches the caller
+    state['fail'] = True
+    pool.take('a')
+    pool.take('a')
+    checks.append((wait_until(lambda: pool._pending['a'] == 0), True))
+    checks.append((pooled(pool, 'a'), 0))
+    try:
+        pool.take('a')
+        checks.append(('no error', 'ConnectionError'))
+    except ConnectionError:
+        checks.append(('ConnectionError', 'ConnectionError'))
+    state['fail'] = False
+    checks.append((pool.take('a').startswith('a-'), True))
+    # Keys the pool was not created with work too
+    checks.append((pool.take('c').startswith('c-'), True))
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for LLM response pool tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('LLM response pool sanity check passed!')
+    print()
+    return tests_passed
+
+def test_llm_turn():
+    print("Testing the LLM calls of a turn...")
+    from types import SimpleNamespace
+
+    chatbot = Chatbot(False)
+    chatbot.llm_enabled = True
+    chatbot.preamble_pool = SimpleNamespace(take=lambda status: '')
+    calls = []
+
+    def recorded(name, result):
+        def call(*args):
+            calls.append(name)
+            return result(*args) if callable(result) else result
+        return call
+
+    def turn(line, arbitrary=False):
+        del calls[:]
+        chatbot._is_arbitrary_input = recorded('arbitrary', arbitrary)
+        chatbot._llm_arbitrary_input = recorded('arbitrary response', 'Off topic. ')
+        chatbot._acknowledge_emotions = recorded('emotions', 'Noted. ')
+        chatbot.find_movies_by_title = recorded('lookup', [])
+        response = chatbot.process(line)
+        return response, sorted(calls)
+
+    # Only the LLM calls whose results the turn uses are made
+    arbitrary, arbitrary_calls = turn('What is the capital of France?', True)
+    one_title, one_title_calls = turn('I liked "Titanic (1997)"')
+    two_titles, two_titles_calls = turn('I liked "Titanic" and "Heat"')
+    unmatched, unmatched_calls = turn('I liked "Titanic')
+    test_cases = [
+        (arbitrary, 'Off topic. '),
+        (arbitrary_calls, ['arbitrary', 'arbitrary response']),
+        (one_title.startswith('Noted. '), True),
+        (one_title_calls, ['arbitrary', 'emotions', 'lookup']),
+        (two_titles.startswith('Noted. '), True),
+        (two_titles_calls, ['arbitrary', 'emotions']),
+        (unmatched.startswith('It looks like you have an unmatched quote'), True),
+        (unmatched_calls, ['arbitrary']),
+    ]
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(test_cases):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for LLM turn tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('LLM turn sanity check passed!')
+    print()
+    return tests_passed
+
+def test_conversation_history():
+    print("Testing the LLM conversation history...")
+    from conversation import ConversationHistory, movie_opinions
+
+    chatbot = Chatbot(False)
+    checks = []
+
+    def opinions(message):
+        return movie_opinions(chatbot, message)
+
+    # Opinions come from the chatbot's own title and sentiment extraction
+    checks.append(([opinions({'role': role, 'content': content}) for role, content in (
+        ('user', 'I liked "Titanic (1997)"'),
+        ('user', 'I hated "Heat (1995)"'),
+        ('user', 'I saw "Heat (1995)"'),
+        ('assistant', 'You liked "Heat (1995)"'))],
+        [{'Titanic (1997)': 'liked'}, {'Heat (1995)': 'disliked'},
+         {'Heat (1995)': 'mentioned'}, {}]))
+
+    # Over the budget, the oldest turns are dropped, keeping their opinions
+    # (the latest for each movie, at most max_facts) in a summary
+    lines = ['I liked "Titanic (1997)"', 'I hated "Heat (1995)"',
+             'I liked "Jaws (1975)"', 'I saw "Heat (1995)"',
+             'I loved "Alien (1979)"', 'I hated "Titanic (1997)"',
+             'I liked "Fargo (1996)"']
+    history = ConversationHistory('system', max_tokens=80, keep_recent=2,
+                                  extract_facts=opinions, max_facts=3)
+    appended, within_budget = [], True
+    for line in lines:
+        for role, content in (('user', line), ('assistant', 'Noted!')):
+            history.append(role, content)
+            appended.append({'role': role, 'content': content})
+            within_budget &= (history.num_tokens() <= 80
+                              or len(history.recent) <= 2)
+            within_budget &= history.recent == appended[-len(history.recent):]
+    checks.append((within_budget, True))
+    checks.append((list(history.facts.items()),
+                   [('Heat (1995)', 'mentioned'), ('Alien (1979)', 'liked'),
+                    ('Titanic (1997)', 'disliked')]))
+    messages = history.messages()
+    checks.append(([message['role'] for message in messages[:2]], ['system', 'system']))
+    checks.append(('mentioned "Heat (1995)"' in messages[1]['content'], True))
+    checks.append((messages[2:], history.recent))
+
+    # The last keep_recent messages are kept even over the budget
+    history = ConversationHistory('system', max_tokens=10, keep_recent=2)
+    for content in ('one', 'two', 'x' * 400):
+        history.append('user', content)
+    checks.append(([message['content'] for message in history.recent],
+                   ['two', 'x' * 400]))
+
+    # summarize() replaces the fact list, once per compaction
+    summaries = []
+
+    def summarize(summary, dropped):
+        summaries.append([message['content'] for message in dropped])
+        return summary + '|' + ','.join(message['content'] for message in dropped)
+
+    history = ConversationHistory('system', max_tokens=20, keep_recent=1,
+                                  summarize=summarize)
+    for content in ('first', 'second', 'third', 'fourth'):
+        history.append('user', content)
+    checks.append((summaries, [['first'], ['second', 'third']]))
+    checks.append((history.messages()[1]['content'], '|first|second,third'))
+
+    tests_passed = True
+    for i, (given, expected_output) in enumerate(checks):
+        if not assert_list_equals(
+                [given],
+                [expected_output],
+                "Test case #{} for conversation history tests failed".format(i),
+        ):
+            tests_passed = False
+    if tests_passed:
+        print('conversation history sanity check passed!')
+    print()
+    return tests_passed
+
 def test_extract_emotion():
     print("Testing extract_emotion() functionality... (This might take a moment if you use LLM JSON Outputs!)")
     chatbot = Chatbot(True)
@@ -327,6 +1212,32 @@ def main():
                         action='store_true')
     parser.add_argument('--binarize', help='Tests only the binarize function',
                         action='store_true')
+    parser.add_argument('--stemmer', help='Tests only the fast stemmer',
+                        action='store_true')
+    parser.add_argument('--ratings-loading',
+                        help='Tests only loading, parsing and snapshotting the ratings',
+                        action='store_true')
+    parser.add_argument('--score-profiles',
+                        help='Tests only the score_profiles.py script',
+                        action='store_true')
+    parser.add_argument('--delta-log',
+                        help='Tests only the delta log of new ratings',
+                        action='store_true')
+    parser.add_argument('--server',
+                        help='Tests only the server.py HTTP server',
+                        action='store_true')
+    parser.add_argument('--llm-cache',
+                        help='Tests only the LLM response cache',
+                        action='store_true')
+    parser.add_argument('--llm-pool',
+                        help='Tests only the pool of pre-generated LLM responses',
+                        action='store_true')
+    parser.add_argument('--conversation-history',
+                        help='Tests only the token-bounded LLM conversation history',
+                        action='store_true')
+    parser.add_argument('--llm-turn',
+                        help='Tests only which LLM calls a turn makes',
+                        action='store_true')
     parser.add_argument('--similarity',
                         help='Tests only the similarity function',
                         action='store_true')
@@ -356,6 +1267,33 @@ def main():
     if args.similarity:
         test_similarity()
         return
+    if args.stemmer:
+        test_stemmer()
+        return
+    if args.ratings_loading:
+        test_ratings_loading()
+        return
+    if args.score_profiles:
+        test_score_profiles()
+        return
+    if args.delta_log:
+        test_delta_log()
+        return
+    if args.server:
+        test_server()
+        return
+    if args.llm_cache:
+        test_llm_cache()
+        return
+    if args.llm_pool:
+        test_llm_pool()
+        return
+    if args.conversation_history:
+        test_conversation_history()
+        return
+    if args.llm_turn:
+        test_llm_turn()
+        return
     if args.extract_emotion:
         test_extract_emotion()
         return
@@ -374,6 +1312,15 @@ def main():
         test_recommend()
         test_binarize()
         test_similarity()
+        test_stemmer()
+        test_ratings_loading()
+        test_score_profiles()
+        test_delta_log()
+        test_server()
+        test_llm_cache()
+        test_llm_pool()
+        test_conversation_history()
+        test_llm_turn()
 
     if testing_llm_programming or testing_all:
         test_extract_emotion()
@@ -5,65 +5,934 @@ Ported to Python 3 by Matt Mistele (@mmistele) and Sam Redmond (@sredmond).
 Intended for PA7 in Stanford's CS124.
 """
 import csv
+import hashlib
+import io
 import json
-from typing import Tuple, List, Dict
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Tuple, List, Dict, Optional
 from functools import lru_cache
 
 import numpy as np
-from openai import OpenAI, APIConnectionError
 
 DEFAULT_STOP = ["\n\n\n\n\n", "<</SYS>>"]
 
+# Parsed data files are snapshotted here so later runs can skip re-parsing.
+# Bump SNAPSHOT_VERSION whenever the snapshot layout or contents change.
+SNAPSHOT_DIR = 'data/cache'
+SNAPSHOT_VERSION = 1
+
+# Ratings files larger than this are ingested in chunks of this many bytes
+# by ingest_ratings() when a sparse snapshot is built
+INGEST_CHUNK_BYTES = 64 << 20
+
+# Worker processes load_ratings() and load_titles() parse a file with by
+# default, and the smallest byte range worth handing to one of them
+PARSE_WORKERS = 1
+MIN_PARSE_RANGE_BYTES = 1 << 20
+
+# Number of LLM requests submit_llm_call() lets run at the same time
+LLM_MAX_WORKERS = 8
+
+
+def line_ranges(src_filename: str, num_ranges: int,
+                header: bool = False) -> List[Tuple[int, int]]:
+    """Split a file into at most num_ranges (start, stop) byte ranges that
+    each hold a whole number of lines, skipping the header line if any."""
+    size = os.path.getsize(src_filename)
+    with open(src_filename, 'rb') as f:
+        if header:
+            f.readline()
+        start = f.tell()
+        boundaries = [start]
+        for i in range(1, num_ranges):
+            target = start + (size - start) * i // num_ranges
+            if target <= boundaries[-1]:
+                continue
+            # Move the boundary to just after the next newline
+            f.seek(target - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > boundaries[-1]:
+                boundaries.append(f.tell())
+        boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _read_range(src_filename: str, start: int, stop: int) -> bytes:
+    with open(src_filename, 'rb') as f:
+        f.seek(start)
+        return f.read(stop - start)
+
+
+def _parse_ratings_range(src_filename: str, start: int, stop: int,
+                         delimiter: str):
+    return parse_ratings_bytes(_read_range(src_filename, start, stop), delimiter)
+
+
+def _map_line_ranges(fn, src_filename: str, header: bool, workers: int,
+                     *args) -> List:
+    """[fn(src_filename, start, stop, *args)] over the file's line ranges,
+    run in a pool of up to workers processes when the file is big enough."""
+    num_ranges = max(1, min(workers,
+                            os.path.getsize(src_filename) // MIN_PARSE_RANGE_BYTES))
+    ranges = line_ranges(src_filename, num_ranges, header)
+    if len(ranges) <= 1:
+        return [fn(src_filename, start, stop, *args) for start, stop in ranges]
+    with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [executor.submit(fn, src_filename, start, stop, *args)
+                   for start, stop in ranges]
+        return [future.result() for future in futures]
+
+
+def parse_ratings(src_filename: str, delimiter: str = '%',
+                  header: bool = False, workers: Optional[int] = None
+                  ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parse a user%movie%rating file into (users, movies, ratings) arrays.
+
+    The file is parsed by NumPy's text parser instead of a Python
+    int()/float() call per field. With workers > 1, large files are split on
+    line boundaries into byte ranges that are parsed in parallel by a pool of
+    processes, and the results concatenated in file order.
+
+    :param workers: number of processes (default PARSE_WORKERS)
+    :returns: int32 user ids, int32 movie ids and float32 ratings, in file order
+    """
+    parts = _map_line_ranges(_parse_ratings_range, src_filename, header,
+                             workers or PARSE_WORKERS, delimiter)
+    if not parts:
+        return parse_ratings_bytes(b'', delimiter)
+    if len(parts) == 1:
+        return parts[0]
+    return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def parse_ratings_bytes(data: bytes, delimiter: str = '%'
+                        ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """parse_ratings() for the contents of (a whole number of lines of) a
+    ratings file."""
+    text = data.replace(delimiter.encode('ascii'), b' ').strip()
+    if not text:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32),
+                np.empty(0, dtype=np.float32))
+    num_lines = text.count(b'\n') + 1
+    try:
+        with warnings.catch_warnings():
+            # NumPy only warns when it hits text it cannot parse
+            warnings.simplefilter('error', DeprecationWarning)
+            fields = np.fromstring(text, dtype=np.float64, sep=' ')
+    except (DeprecationWarning, ValueError):
+        fields = None
+    if fields is None or fields.size != 3 * num_lines:
+        raise ValueError('malformed ratings data: expected 3 numeric fields '
+                         'on each of {} lines'.format(num_lines))
+    fields = fields.reshape(-1, 3)
+    return (fields[:, 0].astype(np.int32), fields[:, 1].astype(np.int32),
+            fields[:, 2].astype(np.float32))
+
+
 def load_ratings(src_filename, delimiter: str = '%',
-                 header: bool = False) -> Tuple[List, np.ndarray]:
-    title_list = load_titles('data/movies.txt')
-    user_id_set = set()
-    with open(src_filename, 'r') as f:
-        content = f.readlines()
-        for line in content:
-            user_id = int(line.split(delimiter)[0])
-            if user_id not in user_id_set:
-                user_id_set.add(user_id)
-    num_users = len(user_id_set)
+                 header: bool = False, sparse: bool = False,
+                 titles_filename: str = 'data/movies.txt',
+                 workers: Optional[int] = None) -> Tuple[List, np.ndarray]:
+    """Load the titles and the (num_movies x num_users) raw ratings matrix.
+
+    With sparse=True the matrix is returned as a scipy.sparse CSR matrix,
+    so memory scales with the number of ratings rather than movies x users.
+    workers is the number of processes both files are parsed with (see
+    parse_ratings()).
+    """
+    title_list = load_titles(titles_filename, workers=workers)
+    users, movies, ratings = parse_ratings(src_filename, delimiter, header,
+                                           workers)
+    # Users are columns by id; ids past the number of distinct users (e.g.
+    # users added later through a delta log) widen the matrix
+    num_users = max(len(np.unique(users)), int(users.max()) + 1 if len(users) else 0)
     num_movies = len(title_list)
-    mat = np.zeros((num_movies, num_users))
 
-    with open(src_filename) as f:
-        reader = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
-        if header:
-            next(reader)
-        for line in reader:
-            mat[int(line[1])][int(line[0])] = float(line[2])
+    if sparse:
+        return title_list, coo_to_csr(movies, users, ratings,
+                                      (num_movies, num_users))
+
+    # Keep the last rating of a repeated (movie, user) pair, like assigning
+    # the ratings one at a time would
+    keep = _last_occurrences(movies, users, num_users)
+    mat = np.zeros((num_movies, num_users))
+    mat[movies[keep], users[keep]] = ratings[keep]
     return title_list, mat
 
 
+def _last_occurrences(rows: np.ndarray, cols: np.ndarray,
+                      num_cols: int) -> np.ndarray:
+    """Indices of the last occurrence of every distinct (row, col) pair."""
+    # np.unique keeps the first occurrence, so search the reversed pairs
+    keys = rows.astype(np.int64) * num_cols + cols
+    _, last = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - last
+
+
+def coo_to_csr(rows, cols, values, shape):
+    """Build a CSR matrix from (row, col, value) triplets.
+
+    Repeated (row, col) pairs keep their last value, matching what
+    element-wise assignment into a dense matrix would do.
+    """
+    import scipy.sparse
+
+    rows = np.asarray(rows, dtype=np.int32)
+    cols = np.asarray(cols, dtype=np.int32)
+    values = np.asarray(values)
+    keep = _last_occurrences(rows, cols, shape[1])
+    return scipy.sparse.csr_matrix(
+        (values[keep], (rows[keep], cols[keep])), shape=shape)
+
+
+def issparse(matrix) -> bool:
+    """scipy.sparse.issparse() that does not import scipy for dense input.
+
+    Nothing can be a scipy sparse matrix before scipy.sparse is imported,
+    so the dense code paths never pay scipy's import time.
+    """
+    sparse_module = sys.modules.get('scipy.sparse')
+    return sparse_module is not None and sparse_module.issparse(matrix)
+
+
 def load_titles(src_filename: str, delimiter: str = '%',
-                header: bool = False) -> List:
-    title_list = []
-    with open(src_filename, 'r', encoding='utf-8') as f:
-        reader = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
-        if header:
-            next(reader)
+                header: bool = False, workers: Optional[int] = None) -> List:
+    """Load [title, genres] for every line of movies.txt.
+
+    With workers > 1, large files are parsed in parallel like
+    parse_ratings(); no quoted field may then span several lines.
+    """
+    parts = _map_line_ranges(_parse_titles_range, src_filename, header,
+                             workers or PARSE_WORKERS, delimiter)
+    return [title for part in parts for title in part]
 
-        for line in reader:
-            movieID, title, genres = int(line[0]), line[1], line[2]
-            if title[0] == '"' and title[-1] == '"':
-                title = title[1:-1]
-            title_list.append([title, genres])
+
+def _parse_titles_range(src_filename: str, start: int, stop: int,
+                        delimiter: str) -> List:
+    title_list = []
+    lines = _read_range(src_filename, start, stop).decode('utf-8')
+    reader = csv.reader(io.StringIO(lines, newline=''), delimiter=delimiter,
+                        quoting=csv.QUOTE_MINIMAL)
+    for line in reader:
+        movieID, title, genres = int(line[0]), line[1], line[2]
+        if title[0] == '"' and title[-1] == '"':
+            title = title[1:-1]
+        title_list.append([title, genres])
     return title_list
 
 
-def load_sentiment_dictionary(src_filename: str, delimiter: str = ',',
-                              header: bool = False) -> Dict:
+def file_fingerprint(src_filename: str, with_hash: bool = True) -> Dict:
+    """Return the size, mtime and (optionally) sha256 of a file."""
+    stat = os.stat(src_filename)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(src_filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+def fingerprint_matches(src_filename: str, fingerprint: Dict) -> bool:
+    """Check a file against a fingerprint from file_fingerprint().
+
+    Size and mtime are compared first; the content hash is only recomputed
+    when the size matches but the mtime moved (e.g. after a fresh checkout).
+    If the hash still matches, fingerprint's mtime is updated in place, so
+    a caller that saves it back skips hashing the file next time.
+    """
+    try:
+        current = file_fingerprint(src_filename, with_hash=False)
+    except OSError:
+        return False
+    if current['size'] != fingerprint.get('size'):
+        return False
+    if current['mtime_ns'] == fingerprint.get('mtime_ns'):
+        return True
+    if file_fingerprint(src_filename)['sha256'] != fingerprint.get('sha256'):
+        return False
+    fingerprint['mtime_ns'] = current['mtime_ns']
+    return True
+
+
+def _snapshot_paths(src_filename: str, snapshot_dir: str,
+                    sparse: bool = False) -> Tuple[str, str]:
+    name = os.path.splitext(os.path.basename(src_filename))[0]
+    base = os.path.join(snapshot_dir, f'{name}-v{SNAPSHOT_VERSION}')
+    if sparse:
+        base += '-csr'
+    return base, base + '.json'
+
+
+def _save_matrix(base: str, matrix, norms: Optional[np.ndarray] = None) -> None:
+    if issparse(matrix):
+        for part in ('data', 'indices', 'indptr'):
+            array = getattr(matrix, part)
+            _atomic_write(f'{base}.{part}.npy', lambda f: np.save(f, array))
+    else:
+        _atomic_write(base + '.npy', lambda f: np.save(f, matrix))
+    if norms is not None:
+        _atomic_write(base + '.norms.npy', lambda f: np.save(f, norms))
+
+
+def _load_matrix(base: str, meta: Dict, mmap_mode: str):
+    if meta.get('format') != 'csr':
+        return np.load(base + '.npy', mmap_mode=mmap_mode)
+
+    import scipy.sparse
+
+    data, indices, indptr = (np.load(f'{base}.{part}.npy', mmap_mode=mmap_mode)
+                             for part in ('data', 'indices', 'indptr'))
+    return scipy.sparse.csr_matrix((data, indices, indptr),
+                                   shape=tuple(meta['shape']), copy=False)
+
+
+def _temp_path(path: str) -> str:
+    """Name of a new, empty temp file next to path, unique to this caller
+    so concurrent snapshot builds never write to the same file."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix=os.path.basename(path) + '.',
+                                    suffix='.tmp')
+    os.close(fd)
+    return tmp_path
+
+
+def row_norms(matrix, block_rows: int = 4096) -> np.ndarray:
+    """L2 norm of every row of a dense or scipy sparse matrix, as float64.
+
+    The rows are cast to float block_rows at a time, so an int8 snapshot is
+    never copied whole.
+    """
+    norms = np.empty(matrix.shape[0])
+    for start in range(0, matrix.shape[0], block_rows):
+        block = matrix[start:start + block_rows]
+        if issparse(block):
+            block = block.astype(np.float64)
+            norms[start:start + block_rows] = np.sqrt(np.asarray(
+                block.multiply(block).sum(axis=1))).ravel()
+        else:
+            norms[start:start + block_rows] = np.linalg.norm(
+                np.asarray(block, dtype=np.float64), axis=1)
+    return norms
+
+
+def _atomic_write(path: str, write: Callable) -> None:
+    """Write a file through write(f) into a temp file, then rename it over
+    path so readers never observe a partially written snapshot."""
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_snapshot_meta(meta_path: str, sources: Dict[str, str],
+                       **expected) -> Optional[Dict]:
+    """Return a snapshot's metadata if the snapshot is still fresh, else None.
+
+    Fresh means it has the current SNAPSHOT_VERSION, every field in expected
+    has the given value, and it was built from the same source files (by
+    fingerprint_matches()) as the {name: path} in sources.
+    """
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        mtimes = [fingerprint.get('mtime_ns') for fingerprint in meta['sources'].values()]
+        if (meta.get('version') == SNAPSHOT_VERSION
+                and all(meta.get(key) == value for key, value in expected.items())
+                and set(meta['sources']) == set(sources)
+                and all(fingerprint_matches(path, meta['sources'][key])
+                        for key, path in sources.items())):
+            if mtimes != [fingerprint.get('mtime_ns')
+                          for fingerprint in meta['sources'].values()]:
+                # Only the mtimes moved: save them so the next start does
+                # not hash the sources again
+                try:
+                    _atomic_write(meta_path, lambda f: f.write(
+                        json.dumps(meta).encode('utf-8')))
+                except OSError:
+                    pass
+            return meta
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    return None
+
+
+def write_snapshot_meta(meta_path: str, sources: Dict[str, str],
+                        **fields) -> Dict:
+    """Atomically write the metadata read back by read_snapshot_meta()."""
+    meta = dict(version=SNAPSHOT_VERSION, **fields,
+                sources={key: file_fingerprint(path)
+                         for key, path in sources.items()})
+    _atomic_write(meta_path, lambda f: f.write(
+        json.dumps(meta).encode('utf-8')))
+    return meta
+
+
+def load_binarized_ratings(src_filename: str, binarize: Callable,
+                           titles_filename: str = 'data/movies.txt',
+                           snapshot_dir: str = SNAPSHOT_DIR,
+                           mmap_mode: str = 'r',
+                           sparse: bool = False,
+                           chunk_bytes: int = INGEST_CHUNK_BYTES,
+                           workers: Optional[int] = None) -> Tuple[List, np.ndarray]:
+    """Load the titles and binarized ratings matrix, using a snapshot on disk.
+
+    The first call parses src_filename with load_ratings(), binarizes it and
+    writes the matrix (as int8) to versioned .npy files next to a .json file
+    holding the titles and fingerprints of both source files. Later calls
+    memory-map those .npy files as long as neither source file has changed.
+
+    :param src_filename: path to ratings.txt
+    :param binarize: function turning the raw ratings matrix into +1/0/-1
+    :param titles_filename: path to movies.txt
+    :param snapshot_dir: directory the snapshot files are kept in
+    :param mmap_mode: mode passed to np.load() for the snapshot arrays
+    :param sparse: load and snapshot the matrix in scipy CSR form
+    :param chunk_bytes: sparse snapshots of ratings files larger than this
+      are built out of core by ingest_ratings(), chunk_bytes at a time
+    :param workers: number of processes parsing the files (see parse_ratings())
+    :returns: (title_list, binarized ratings matrix); the matrix is int8,
+      so cast rows to float before taking their products
+    """
+    base, meta_path = _snapshot_paths(src_filename, snapshot_dir, sparse)
+    sources = {'ratings': src_filename, 'titles': titles_filename}
+
+    meta = read_snapshot_meta(meta_path, sources)
+    if meta is not None:
+        try:
+            return meta['titles'], _load_matrix(base, meta, mmap_mode)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if sparse and os.path.getsize(src_filename) > chunk_bytes:
+        try:
+            return ingest_ratings(src_filename, binarize, titles_filename,
+                                  snapshot_dir, chunk_bytes, mmap_mode=mmap_mode,
+                                  workers=workers)
+        except OSError:
+            pass
+
+    title_list, ratings = load_ratings(src_filename, sparse=sparse,
+                                       titles_filename=titles_filename,
+                                       workers=workers)
+    binarized = binarize(ratings)
+    try:
+        return title_list, save_binarized_ratings(
+            binarized, title_list, src_filename, titles_filename, snapshot_dir,
+            mmap_mode)
+    except OSError:
+        # A read-only checkout still works, it just re-parses every time.
+        return title_list, binarized
+
+
+def load_row_norms(src_filename: str, titles_filename: str = 'data/movies.txt',
+                   snapshot_dir: str = SNAPSHOT_DIR,
+                   sparse: bool = False) -> Optional[np.ndarray]:
+    """The row norms saved with the binarized ratings snapshot of
+    src_filename (see load_binarized_ratings()), or None if the snapshot is
+    stale or has none."""
+    base, meta_path = _snapshot_paths(src_filename, snapshot_dir, sparse)
+    meta = read_snapshot_meta(meta_path, {'ratings': src_filename,
+                                          'titles': titles_filename})
+    if meta is None or not meta.get('norms'):
+        return None
+    try:
+        norms = np.load(base + '.norms.npy')
+    except (OSError, ValueError):
+        return None
+    return norms if norms.shape == (meta['shape'][0],) else None
+
+
+def save_binarized_ratings(binarized, title_list: List, src_filename: str,
+                           titles_filename: str = 'data/movies.txt',
+                           snapshot_dir: str = SNAPSHOT_DIR,
+                           mmap_mode: str = 'r',
+                           norms: Optional[np.ndarray] = None):
+    """Write a binarized ratings matrix and its row norms as the snapshot
+    load_binarized_ratings() and load_row_norms() reuse for the current
+    contents of src_filename and titles_filename.
+
+    :param binarized: dense or scipy sparse binarized ratings matrix
+    :param title_list: the titles stored next to it
+    :param norms: the matrix's row norms, if already known (see row_norms())
+    :returns: the saved matrix, memory-mapped from the snapshot files
+    """
+    sparse = issparse(binarized)
+    if sparse:
+        binarized = binarized.tocsr().astype(np.int8)
+    else:
+        binarized = np.asarray(binarized).astype(np.int8)
+    base, meta_path = _snapshot_paths(src_filename, snapshot_dir, sparse)
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'format': 'csr' if sparse else 'dense',
+        'shape': list(binarized.shape),
+        'norms': True,
+        'sources': {'ratings': file_fingerprint(src_filename),
+                    'titles': file_fingerprint(titles_filename)},
+        'titles': title_list,
+    }
+    os.makedirs(snapshot_dir, exist_ok=True)
+    _save_matrix(base, binarized, row_norms(binarized) if norms is None
+                 else np.asarray(norms, dtype=np.float64))
+    _atomic_write(meta_path, lambda f: f.write(
+        json.dumps(meta).encode('utf-8')))
+    return _load_matrix(base, meta, mmap_mode)
+
+
+def _iter_rating_chunks(src_filename: str, chunk_bytes: int, delimiter: str,
+                        header: bool, workers: int):
+    """Yield parse_ratings_bytes() of the file's line ranges of about
+    chunk_bytes each, in file order. With workers > 1 the ranges are parsed
+    by a pool of processes, at most workers ranges ahead of the consumer."""
+    size = os.path.getsize(src_filename)
+    ranges = line_ranges(src_filename, max(1, -(-size // chunk_bytes)), header)
+    if workers <= 1 or len(ranges) <= 1:
+        for start, stop in ranges:
+            yield _parse_ratings_range(src_filename, start, stop, delimiter)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for start, stop in ranges:
+            pending.append(executor.submit(_parse_ratings_range, src_filename,
+                                           start, stop, delimiter))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def ingest_ratings(src_filename: str, binarize: Callable,
+                   titles_filename: str = 'data/movies.txt',
+                   snapshot_dir: str = SNAPSHOT_DIR,
+                   chunk_bytes: int = INGEST_CHUNK_BYTES,
+                   delimiter: str = '%', header: bool = False,
+                   mmap_mode: str = 'r',
+                   workers: Optional[int] = None) -> Tuple[List, object]:
+    """Build the sparse binarized ratings snapshot without loading the file.
+
+    Writes the same files as load_binarized_ratings(sparse=True), row norms
+    included, while holding only about chunk_bytes of ratings in memory:
+
+    1. Stream the file once, counting each movie's ratings and collecting
+       the distinct users, to size the CSR arrays.
+    2. Stream it again, binarizing each chunk and scattering its entries
+       into their movies' rows of on-disk (memory-mapped) arrays.
+    3. Sort every row by user and keep the last rating of a repeated
+       (movie, user) pair, a block of rows at a time, writing the final
+       data/indices arrays and each movie's norm.
+
+    :param src_filename: path to ratings.txt
+    :param binarize: function mapping a 1D array of raw ratings to +1/0/-1
+    :param titles_filename: path to movies.txt
+    :param snapshot_dir: directory the snapshot files are kept in
+    :param chunk_bytes: bytes of ratings.txt parsed at a time
+    :param mmap_mode: mode passed to np.load() for the returned matrix
+    :param workers: number of processes parsing the chunks of both passes
+      (default PARSE_WORKERS); up to workers chunks are held at a time
+    :returns: (title_list, memory-mapped binarized CSR ratings matrix)
+    :raises ValueError: if a rating's movie id is not in titles_filename or
+      its user id is negative
+    """
+    import scipy.sparse
+
+    workers = workers or PARSE_WORKERS
+    title_list = load_titles(titles_filename, workers=workers)
+    num_movies = len(title_list)
+    base, meta_path = _snapshot_paths(src_filename, snapshot_dir, sparse=True)
+    os.makedirs(snapshot_dir, exist_ok=True)
+
+    # 1. Ratings per movie and distinct users
+    counts = np.zeros(num_movies, dtype=np.int64)
+    user_ids = np.empty(0, dtype=np.int32)
+    for users, movies, _ in _iter_rating_chunks(src_filename, chunk_bytes,
+                                                delimiter, header, workers):
+        if len(movies) and (movies.min() < 0 or movies.max() >= num_movies
+                            or users.min() < 0):
+            raise ValueError(f'{src_filename} has ratings of unknown movies '
+                             f'or negative user ids')
+        counts += np.bincount(movies, minlength=num_movies)
+        user_ids = np.union1d(user_ids, users)
+    num_users = max(len(user_ids), int(user_ids.max()) + 1 if len(user_ids) else 0)
+    num_entries = int(counts.sum())
+    index_dtype = np.int32 if num_entries < np.iinfo(np.int32).max else np.int64
+
+    # 2. Scatter every entry into its movie's row, in file order
+    row_starts = np.concatenate([[0], np.cumsum(counts)])
+    temp_paths = [_temp_path(f'{base}.{part}.npy')
+                  for part in ('unsorted.data', 'unsorted.indices', 'data', 'indices')]
+    try:
+        unsorted_data = np.lib.format.open_memmap(
+            temp_paths[0], mode='w+', dtype=np.int8, shape=(num_entries,))
+        unsorted_indices = np.lib.format.open_memmap(
+            temp_paths[1], mode='w+', dtype=np.int32, shape=(num_entries,))
+        next_position = row_starts[:-1].copy()
+        for users, movies, ratings in _iter_rating_chunks(
+                src_filename, chunk_bytes, delimiter, header, workers):
+            order = np.argsort(movies, kind='stable')
+            movies, users = movies[order], users[order]
+            values = np.asarray(binarize(ratings[order].astype(np.float64)))
+            # Position of each entry among the chunk's entries for its movie
+            chunk_counts = np.bincount(movies, minlength=num_movies)
+            group_starts = np.concatenate([[0], np.cumsum(chunk_counts)])[movies]
+            positions = next_position[movies] + np.arange(len(movies)) - group_starts
+            unsorted_data[positions] = values
+            unsorted_indices[positions] = users
+            next_position += chunk_counts
+
+        # 3. Sort and deduplicate rows in blocks of about one chunk of
+        # entries. A block only shrinks, so it is written back to the start
+        # of its own range, then copied to its final place once every row's
+        # size is known.
+        block_entries = max(chunk_bytes // 16, 1)
+        blocks = []
+        row_sizes = np.zeros(num_movies, dtype=np.int64)
+        norms = np.zeros(num_movies)
+        start = 0
+        while start < num_movies:
+            stop = int(np.searchsorted(row_starts, row_starts[start] + block_entries,
+                                       side='right')) - 1
+            stop = min(max(stop, start + 1), num_movies)
+            lo, hi = row_starts[start], row_starts[stop]
+            rows = np.repeat(np.arange(start, stop), counts[start:stop])
+            columns = np.asarray(unsorted_indices[lo:hi])
+            keep = _last_occurrences(rows, columns, num_users)  # sorted by (row, col)
+            values = np.asarray(unsorted_data[lo:hi])[keep]
+            nonzero = values != 0
+            rows, values = rows[keep][nonzero], values[nonzero]
+            unsorted_indices[lo:lo + len(values)] = columns[keep][nonzero]
+            unsorted_data[lo:lo + len(values)] = values
+            row_sizes += np.bincount(rows, minlength=num_movies)
+            norms += np.bincount(rows, weights=values.astype(np.float64) ** 2,
+                                 minlength=num_movies)
+            blocks.append((start, stop))
+            start = stop
+        indptr = np.concatenate([[0], np.cumsum(row_sizes)]).astype(index_dtype)
+        nnz = int(indptr[-1])
+
+        data = np.lib.format.open_memmap(temp_paths[2], mode='w+',
+                                         dtype=np.int8, shape=(nnz,))
+        indices = np.lib.format.open_memmap(temp_paths[3], mode='w+',
+                                            dtype=np.int32, shape=(nnz,))
+        for start, stop in blocks:
+            lo, size = row_starts[start], indptr[stop] - indptr[start]
+            data[indptr[start]:indptr[stop]] = unsorted_data[lo:lo + size]
+            indices[indptr[start]:indptr[stop]] = unsorted_indices[lo:lo + size]
+        data.flush()
+        indices.flush()
+        del data, indices, unsorted_data, unsorted_indices
+        os.replace(temp_paths[2], base + '.data.npy')
+        os.replace(temp_paths[3], base + '.indices.npy')
+        _atomic_write(base + '.indptr.npy', lambda f: np.save(f, indptr))
+        norms = np.sqrt(norms)
+        _atomic_write(base + '.norms.npy', lambda f: np.save(f, norms))
+    finally:
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'format': 'csr',
+        'shape': [num_movies, num_users],
+        'norms': True,
+        'sources': {'ratings': file_fingerprint(src_filename),
+                    'titles': file_fingerprint(titles_filename)},
+        'titles': title_list,
+    }
+    _atomic_write(meta_path, lambda f: f.write(json.dumps(meta).encode('utf-8')))
+    return title_list, _load_matrix(base, meta, mmap_mode)
+
+
+# Polarity stored in the compiled sentiment lexicon for each label
+SENTIMENT_POLARITY = {'pos': 1, 'neg': -1}
+
+
+def load_sentiment_lexicon(src_filename: str, stem: Callable,
+                           snapshot_dir: str = SNAPSHOT_DIR,
+                           delimiter: str = ',',
+                           header: bool = False) -> Dict[str, int]:
+    """Load sentiment.txt as a {stem: polarity} dictionary (+1 pos, -1 neg).
+
+    Stemming the whole lexicon is the slow part, so the compiled lexicon is
+    saved under snapshot_dir as two .npy files, the stems and their int8
+    polarities, and reused as long as the source file and the stemmer (by
+    module and name) are unchanged. When two words share a stem, the later
+    line wins, as when building the dictionary directly. Words labelled
+    anything but pos or neg are left out.
+
+    :param src_filename: path to sentiment.txt
+    :param stem: function returning the stem of a word
+    :param snapshot_dir: directory the compiled lexicon is kept in
+    :returns: dictionary from stem to polarity
+    """
+    base, meta_path = _snapshot_paths(src_filename, snapshot_dir)
+    sources = {'source': src_filename}
+    stemmer_name = f'{stem.__module__}.{stem.__qualname__}'
+
+    if read_snapshot_meta(meta_path, sources, stemmer=stemmer_name) is not None:
+        try:
+            stems = np.load(base + '.stems.npy')
+            polarities = np.load(base + '.polarity.npy')
+            return dict(zip(stems.tolist(), polarities.tolist()))
+        except (OSError, ValueError):
+            pass
+
+    lexicon = {}
     with open(src_filename, 'r') as f:
         reader = csv.reader(f, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
         if header:
             next(reader)
-        return dict(reader)
+        for word, sentiment in reader:
+            if sentiment in SENTIMENT_POLARITY:
+                lexicon[stem(word)] = SENTIMENT_POLARITY[sentiment]
+
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        stems = np.array(list(lexicon), dtype=str)
+        polarities = np.fromiter(lexicon.values(), dtype=np.int8, count=len(lexicon))
+        _atomic_write(base + '.stems.npy', lambda f: np.save(f, stems))
+        _atomic_write(base + '.polarity.npy', lambda f: np.save(f, polarities))
+        write_snapshot_meta(meta_path, sources, stemmer=stemmer_name)
+    except OSError:
+        pass
+    return lexicon
+
+class LLMResponseCache:
+    """Cache of LLM responses keyed by a hash of the full request.
+
+    Responses live in an in-process LRU of at most max_entries items and, if
+    path is given, in a sqlite database of at most max_disk_entries rows so
+    they survive restarts. Entries older than ttl seconds are treated as
+    missing. Only JSON-serializable responses can be cached.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 7 * 24 * 3600,
+                 path: Optional[str] = None, max_disk_entries: int = 100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, '
+                'value TEXT NOT NULL, created_at REAL NOT NULL, '
+                'accessed_at REAL NOT NULL)')
+            self._db.commit()
+
+    @staticmethod
+    def key(*request) -> str:
+        """Hash the request parameters into a cache key."""
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        """Return the cached response for key, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            if key in self._memory:
+                created_at, value = self._memory[key]
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                'SELECT value, created_at FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self._db.commit()
+                return None
+            self._db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?',
+                             (now, key))
+            self._db.commit()
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            return value
+
+    def put(self, key: str, value) -> None:
+        """Store a response under key in memory and, if enabled, on disk."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, value)
+            if self._db is None:
+                return
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now, now))
+            # Evict the least recently used rows beyond the size bound
+            self._db.execute(
+                'DELETE FROM responses WHERE key IN (SELECT key FROM responses '
+                'ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_disk_entries,))
+            self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM responses')
+                self._db.commit()
+
+    def _remember(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+
+# Shared cache used by simple_llm_call/json_llm_call when use_cache=True
+llm_cache = LLMResponseCache()
+
+
+def configure_llm_cache(path: Optional[str] = None, **kwargs) -> LLMResponseCache:
+    """Replace the shared LLM response cache, e.g. to persist it to sqlite.
+
+    :param path: sqlite file to keep responses in, or None for memory only
+    :param kwargs: other LLMResponseCache arguments (max_entries, ttl, ...)
+    :returns: the new shared cache
+    """
+    global llm_cache
+    llm_cache = LLMResponseCache(path=path, **kwargs)
+    return llm_cache
+
+_llm_executor = None
+_llm_executor_lock = threading.Lock()
+
+
+def submit_llm_call(fn: Callable, *args, **kwargs) -> Future:
+    """Run fn(*args, **kwargs) on a shared worker thread and return a Future.
+
+    LLM calls spend nearly all their time waiting on the network, so
+    submitting independent calls together and then calling .result() on
+    each lets them overlap instead of running back to back.
+    """
+    global _llm_executor
+    with _llm_executor_lock:
+        if _llm_executor is None:
+            _llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS,
+                                               thread_name_prefix='llm')
+    return _llm_executor.submit(fn, *args, **kwargs)
+
+class LLMResponsePool:
+    """Pre-generated LLM responses, kept ready per key.
+
+    For calls whose output depends only on a small, fixed set of inputs
+    (keys), the pool keeps up to `size` responses per key generated ahead of
+    time on background threads. take() serves from memory and tops the key
+    back up once it drops below `low_water`; only an empty pool falls back to
+    generating synchronously.
+
+    Nothing is generated before the first take(), which starts filling every
+    key. The threads are daemons, so a pool still generating never keeps the
+    process from exiting.
+    """
+
+    def __init__(self, generate: Callable, keys, size: int = 3,
+                 low_water: int = 1, max_workers: int = 2):
+        self.generate = generate
+        self.size = size
+        self.low_water = low_water
+        self._responses = {key: deque() for key in keys}
+        self._pending = {key: 0 for key in keys}
+        self._lock = threading.Lock()
+        self._filled = False
+        # Keys to generate a response for, served by up to max_workers
+        # threads of their own, so refills never queue in front of the LLM
+        # calls a conversation turn is waiting on
+        self._tasks = deque()
+        self._task_ready = threading.Condition(self._lock)
+        self._max_workers = max_workers
+        self._workers = 0
+
+    def fill(self) -> None:
+        """Start generating responses for every key in the background."""
+        self._filled = True
+        for key in list(self._responses):
+            self._refill(key)
+
+    def take(self, key):
+        """Return a pre-generated response for key, refilling as needed."""
+        if not self._filled:
+            self.fill()
+        with self._lock:
+            responses = self._responses.setdefault(key, deque())
+            self._pending.setdefault(key, 0)
+            response = responses.popleft() if responses else None
+            running_low = len(responses) < self.low_water
+        if running_low:
+            self._refill(key)
+        if response is None:
+            response = self.generate(key)
+        return response
+
+    def _refill(self, key) -> None:
+        with self._lock:
+            missing = self.size - len(self._responses[key]) - self._pending[key]
+            if missing <= 0:
+                return
+            self._pending[key] += missing
+            self._tasks.extend([key] * missing)
+            self._task_ready.notify(missing)
+            start = min(missing, self._max_workers - self._workers)
+            self._workers += max(start, 0)
+        for _ in range(start):
+            threading.Thread(target=self._work, name='llm-pool',
+                             daemon=True).start()
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                while not self._tasks:
+                    self._task_ready.wait()
+                key = self._tasks.popleft()
+            self._generate_into_pool(key)
+
+    def _generate_into_pool(self, key) -> None:
+        try:
+            response = self.generate(key)
+        except Exception:
+            # Leave the pool short; take() generates synchronously if empty
+            response = None
+        with self._lock:
+            self._pending[key] -= 1
+            if response is not None:
+                self._responses[key].append(response)
 
 @lru_cache
 def load_together_client():
     together_client = None
+    try:
+        # Imported on first use so non-LLM runs never load the SDK
+        from openai import OpenAI
+    except ImportError:
+        print("\001\033[93m\002WARNING: Unable to load Together API client (the openai package is not installed)\001\033[0m\002")
+        print("\001\033[93m\002LLM Calls will not work.  Please install it with `pip install openai` before starting parts 2 and 3.\001\033[0m\002")
+        return together_client
     try:
         from api_keys import TOGETHER_API_KEY
 
@@ -87,6 +956,8 @@ def call_llm(messages, client, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max
 
 # model = "meta-llama/Llama-2-70b-chat-hf"
 def stream_llm_to_console(messages, client, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max_tokens=256, stop=None):
+    from openai import APIConnectionError
+
     try:
         stream = client.chat.completions.create(
             model=model,
@@ -114,8 +985,16 @@ def stream_llm_to_console(messages, client, model="mistralai/Mixtral-8x7B-Instru
 #   message: The user message to send to the API.
 #   model: The model to use for the API call.
 #   max_tokens: The maximum number of tokens to generate in the response.
+#   use_cache: Reuse the response of an identical earlier call (see llm_cache).
+#     Only use this for calls whose answer should not vary, like classifiers.
 # Returns the response from the API.
-def simple_llm_call(system_prompt, message, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max_tokens=256, stop=None):
+def simple_llm_call(system_prompt, message, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max_tokens=256, stop=None, use_cache=False):
+    if use_cache:
+        cache_key = llm_cache.key('simple', system_prompt, message, model, max_tokens, stop)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     client = load_together_client()
     chat_completion = client.chat.completions.create(
         messages=[{
@@ -130,7 +1009,10 @@ def simple_llm_call(system_prompt, message, model="mistralai/Mixtral-8x7B-Instru
         stop=stop
     )
 
-    return chat_completion.choices[0].message.content
+    response = chat_completion.choices[0].message.content
+    if use_cache and response is not None:
+        llm_cache.put(cache_key, response)
+    return response
 
 
 ### Student Facing API
@@ -140,8 +1022,16 @@ def simple_llm_call(system_prompt, message, model="mistralai/Mixtral-8x7B-Instru
 #   json_class: The class to use for the JSON output.
 #   model: The model to use for the API call.
 #   max_tokens: The maximum number of tokens to generate in the response.
+#   use_cache: Reuse the response of an identical earlier call (see llm_cache).
 # Returns the response from the API as a JSON object
-def json_llm_call(system_prompt, message, json_class, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max_tokens=256):
+def json_llm_call(system_prompt, message, json_class, model="mistralai/Mixtral-8x7B-Instruct-v0.1", max_tokens=256, use_cache=False):
+    schema = json_class.model_json_schema()
+    if use_cache:
+        cache_key = llm_cache.key('json', system_prompt, message, schema, model, max_tokens)
+        cached = llm_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
     client = load_together_client()
     chat_completion = client.chat.completions.create(
         messages=[{
@@ -155,8 +1045,11 @@ def json_llm_call(system_prompt, message, json_class, model="mistralai/Mixtral-8
         max_tokens=max_tokens,
         response_format = {
             "type": "json_object",
-            "schema": json_class.model_json_schema(),
+            "schema": schema,
         }
     )
 
-    return json.loads(chat_completion.choices[0].message.content)
+    response = json.loads(chat_completion.choices[0].message.content)
+    if use_cache:
+        llm_cache.put(cache_key, response)
+    return response